@@ -18,8 +18,10 @@ else:
     from .restart_on import RestartOn
     from .redis.httpcache import RedisCacheStorage
     from .mongo.httpcache import MongoCacheStorage
-    from .httpcache import FilesystemCacheStorage2
+    from .httpcache import (
+        FilesystemCacheStorage2, TieredCacheStorage, AsyncHttpCacheMiddleware)
     from .useragent import PersistentUserAgentMiddleware
     from .pipelines import ItemStorePipeline, EarlyProcessPipeline
     from .scheduler import PersistentScheduler
     from .stats import PersistentStatsCollector
+    from .stats_snapshot import StatsSnapshot
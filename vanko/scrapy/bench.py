@@ -0,0 +1,130 @@
+"""
+Micro-benchmarks for storage encodings. Run as:
+    python -m vanko.scrapy.bench reqser [count]
+    python -m vanko.scrapy.bench cache [count]
+"""
+import sys
+import random
+from time import time
+from scrapy import Spider, Request
+from .reqser import PickleRequestCodec, CompactRequestCodec
+from .cache_codec import CacheCodec, zstandard
+
+
+class BenchSpider(Spider):
+    name = 'bench'
+
+    def parse(self, response):
+        pass
+
+    def parse_item(self, response):
+        pass
+
+
+def sample_requests(spider, count):
+    requests = []
+    for i in xrange(count):
+        url = 'http://www.example.com/catalog/item-%d.html?page=%d' % (
+            i, i % 50)
+        if i % 5:
+            request = Request(url, callback=spider.parse_item)
+        else:
+            request = Request(url, callback=spider.parse, priority=10,
+                              meta={'page': i % 50})
+        request.headers['Referer'] = 'http://www.example.com/catalog/'
+        requests.append(request)
+    return requests
+
+
+def bench_reqser(count=10000):
+    spider = BenchSpider()
+    requests = sample_requests(spider, count)
+    codecs = [
+        ('pickle', PickleRequestCodec()),
+        ('compact', CompactRequestCodec()),
+        ('compact+zlib', CompactRequestCodec('zlib')),
+        ]
+    try:
+        codecs.append(('compact+lz4', CompactRequestCodec('lz4')))
+    except AssertionError:
+        pass
+
+    print '%-14s %10s %12s %12s' % ('codec', 'bytes/req', 'encode/s',
+                                    'decode/s')
+    for name, codec in codecs:
+        start = time()
+        encoded = [codec.encode(r, spider) for r in requests]
+        encode_secs = time() - start
+        start = time()
+        for data in encoded:
+            codec.decode(data, spider)
+        decode_secs = time() - start
+        size = sum(len(data) for data in encoded) / float(count)
+        print '%-14s %10.1f %12d %12d' % (
+            name, size, count / encode_secs, count / decode_secs)
+
+
+def sample_pages(count):
+    rnd = random.Random(count)
+    words = ['item', 'price', 'stock', 'shipping', 'review', 'color',
+             'size', 'brand', 'warranty', 'delivery']
+    header = ('<html><head><title>%s</title><link rel="stylesheet" '
+              'href="/static/site.css"></head><body><div id="menu">' +
+              ''.join('<a href="/catalog/%d">Category %d</a>' % (i, i)
+                      for i in xrange(40)) + '</div>')
+    pages = []
+    for i in xrange(count):
+        rows = ''.join(
+            '<tr><td class="%s">%s %d</td><td>%.2f</td></tr>' % (
+                rnd.choice(words), rnd.choice(words),
+                rnd.randint(1, 10000), rnd.random() * 100)
+            for _ in xrange(rnd.randint(20, 60)))
+        pages.append(header % ('Page %d' % i) +
+                     '<table>%s</table></body></html>' % rows)
+    return pages
+
+
+class _MemoryDictStore(dict):
+    def set(self, name, data):
+        self[name] = data
+
+
+def bench_cache(count=1000):
+    pages = sample_pages(count)
+    total = sum(len(page) for page in pages)
+    names = ['gzip']
+    if zstandard is not None:
+        names.extend(['zstd', 'zstd-dict'])
+
+    print '%-10s %8s %14s %14s' % ('codec', 'ratio', 'compress MB/s',
+                                   'decompress MB/s')
+    for name in names:
+        codec = CacheCodec(name, dict_samples=min(100, count // 2))
+        codec.open(_MemoryDictStore())
+        if name == 'zstd-dict':
+            # train the dictionary outside of the measured run
+            for page in pages[:codec.dict_samples]:
+                codec.compress(page)
+        start = time()
+        packed = [codec.compress(page) for page in pages]
+        compress_secs = time() - start
+        start = time()
+        for data in packed:
+            codec.decompress(data)
+        decompress_secs = time() - start
+        size = sum(len(data) for data in packed)
+        mb = total / 1048576.0
+        print '%-10s %8.2f %14.1f %14.1f' % (
+            name, total / float(size), mb / compress_secs,
+            mb / decompress_secs)
+
+
+BENCHMARKS = {
+    'reqser': bench_reqser,
+    'cache': bench_cache,
+    }
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:] or ['reqser']
+    BENCHMARKS[args[0]](*map(int, args[1:]))
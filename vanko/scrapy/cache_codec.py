@@ -0,0 +1,188 @@
+"""
+Compression codecs for http cache storages.
+Compressed data starts with a marker, so any codec can read data
+written by other codecs:
+    gz~          gzip (bare gzip streams are accepted too)
+    zs~          zstandard
+    zd~<id>~     zstandard with dictionary <id> trained on cached pages
+"""
+import os
+import io
+import logging
+import threading
+from gzip import GzipFile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class CacheCodec(object):
+    CODECS = ('gzip', 'zstd', 'zstd-dict')
+    GZIP_MAGIC = '\x1f\x8b'
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, name='gzip', level=6, dict_samples=200,
+                 dict_size=112640):
+        assert name in self.CODECS, 'Unknown cache codec: %s' % name
+        assert name == 'gzip' or zstandard is not None, \
+            'ImportError: zstandard'
+        self.name = name
+        self.level = level
+        self.dict_samples = dict_samples
+        self.dict_size = dict_size
+        self.dict_store = None
+        self.samples = []
+        self.dicts = {}
+        self.zdict = None
+        self.compressor = None
+        self.lock = threading.Lock()  # compressors are not thread-safe
+        if name != 'gzip':
+            self.compressor = zstandard.ZstdCompressor(
+                level=level, write_content_size=True)
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.get('HTTPCACHE_CODEC', 'gzip'),
+                   settings.getint('HTTPCACHE_COMPRESSLEVEL', 6),
+                   settings.getint('HTTPCACHE_ZSTD_DICT_SAMPLES', 200),
+                   settings.getint('HTTPCACHE_ZSTD_DICT_SIZE', 112640))
+
+    def open(self, dict_store):
+        """Attach per-spider dictionary store, load current dictionary"""
+        self.dict_store = dict_store
+        self.samples = []
+        self.zdict = None
+        if self.name == 'zstd-dict':
+            dict_id = dict_store.get('current')
+            if dict_id:
+                self.zdict = self._load_dict(int(dict_id))
+            if self.zdict:
+                self.compressor = zstandard.ZstdCompressor(
+                    level=self.level, dict_data=self.zdict,
+                    write_content_size=True)
+
+    def is_compressed(self, data):
+        """Check for a codec marker, bare gzip streams are not detected"""
+        return data[:3] in ('gz~', 'zs~', 'zd~')
+
+    def compress(self, data):
+        if self.name == 'gzip':
+            iobuf = io.BytesIO()
+            iobuf.write('gz~')
+            with GzipFile('', 'wb', self.level, iobuf) as gzip:
+                gzip.write(data)
+            return iobuf.getvalue()
+        with self.lock:
+            if self.name == 'zstd-dict' and self.zdict is None:
+                self._add_sample(data)
+            if self.zdict is not None:
+                return 'zd~%d~%s' % (self.zdict.dict_id(),
+                                     self.compressor.compress(data))
+            return 'zs~' + self.compressor.compress(data)
+
+    def decompress(self, data):
+        marker = data[:3]
+        if marker == 'gz~' or data[:2] == self.GZIP_MAGIC:
+            iobuf = io.BytesIO(data)
+            if marker == 'gz~':
+                iobuf.seek(3)
+            with GzipFile('', 'rb', fileobj=iobuf) as gzip:
+                return gzip.read()
+        if marker == 'zs~':
+            return zstandard.ZstdDecompressor().decompress(data[3:])
+        if marker == 'zd~':
+            dict_id, _, data = data[3:].partition('~')
+            zdict = self._load_dict(int(dict_id))
+            assert zdict is not None, \
+                'Cache dictionary %s not found' % dict_id
+            return zstandard.ZstdDecompressor(
+                dict_data=zdict).decompress(data)
+        raise ValueError('Unknown cache compression marker: %r' % marker)
+
+    def _load_dict(self, dict_id):
+        zdict = self.dicts.get(dict_id)
+        if zdict is None and self.dict_store:
+            data = self.dict_store.get('dict-%d' % dict_id)
+            if data:
+                zdict = self.dicts[dict_id] = \
+                    zstandard.ZstdCompressionDict(data)
+        return zdict
+
+    def _add_sample(self, data):
+        self.samples.append(data)
+        if len(self.samples) < self.dict_samples:
+            return
+        samples, self.samples = self.samples, []
+        try:
+            zdict = zstandard.train_dictionary(self.dict_size, samples)
+        except zstandard.ZstdError as err:
+            self.logger.warning('Cannot train cache dictionary: %s', err)
+            return
+        dict_id = zdict.dict_id()
+        if self.dict_store:
+            self.dict_store.set('dict-%d' % dict_id, zdict.as_bytes())
+            self.dict_store.set('current', str(dict_id))
+        self.dicts[dict_id] = self.zdict = zdict
+        self.compressor = zstandard.ZstdCompressor(
+            level=self.level, dict_data=zdict, write_content_size=True)
+        self.logger.info('Trained cache dictionary %d on %d pages',
+                         dict_id, len(samples))
+
+
+class RedisDictStore(object):
+    def __init__(self, redis, key):
+        self.redis = redis
+        self.key = key
+
+    def get(self, name):
+        return self.redis.hget(self.key, name)
+
+    def set(self, name, data):
+        self.redis.hset(self.key, name, data)
+
+
+class MongoDictStore(object):
+    def __init__(self, coll):
+        self.coll = coll
+
+    def get(self, name):
+        return (self.coll.find_one({'_id': name}) or {}).get('data')
+
+    def set(self, name, data):
+        from bson import Binary
+        self.coll.update_one({'_id': name}, {'$set': {'data': Binary(data)}},
+                             upsert=True)
+
+
+class FileDictStore(object):
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, name):
+        path = os.path.join(self.path, name)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return f.read()
+
+    def set(self, name, data):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        with open(os.path.join(self.path, name), 'wb') as f:
+            f.write(data)
+
+
+class CodecWriter(io.BytesIO):
+    """Writable file object compressing its content to path on close"""
+
+    def __init__(self, codec, path):
+        super(CodecWriter, self).__init__()
+        self.codec = codec
+        self.path = path
+
+    def close(self):
+        if not self.closed:
+            with open(self.path, 'wb') as f:
+                f.write(self.codec.compress(self.getvalue()))
+        super(CodecWriter, self).close()
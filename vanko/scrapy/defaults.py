@@ -39,5 +39,6 @@ CUSTOM_SETTINGS = dict(
         'vanko.scrapy.FastExit': 0,
         'vanko.scrapy.RestartOn': 0,
         'vanko.scrapy.ShowIP': 0,
+        'vanko.scrapy.StatsSnapshot': 0,
         },
     )
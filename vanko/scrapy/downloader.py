@@ -1,15 +1,81 @@
 import logging
+from twisted.internet import defer
+from scrapy.http import Request, Response
 from scrapy.core.downloader import Downloader
+from scrapy.core.downloader.middleware import DownloaderMiddlewareManager
 from scrapy.core.downloader.handlers.http import HTTPDownloadHandler
+from scrapy.utils.defer import mustbe_deferred
 
 logger = logging.getLogger('CustomDownloader')
 logger.setLevel(logging.INFO)
 
 
+class AsyncDownloaderMiddlewareManager(DownloaderMiddlewareManager):
+    """
+    Downloader middleware manager which lets middleware methods
+    return a Deferred (e.g. AsyncHttpCacheMiddleware) and waits for it.
+    """
+
+    def download(self, download_func, request, spider):
+        @defer.inlineCallbacks
+        def process_request(request):
+            for method in self.methods['process_request']:
+                response = yield method(request=request, spider=spider)
+                assert response is None or isinstance(
+                    response, (Response, Request)), \
+                    'Middleware %s.process_request must return None, ' \
+                    'Response or Request, got %s' % (
+                        method.im_self.__class__.__name__,
+                        response.__class__.__name__)
+                if response:
+                    defer.returnValue(response)
+            response = yield download_func(request=request, spider=spider)
+            defer.returnValue(response)
+
+        @defer.inlineCallbacks
+        def process_response(response):
+            assert response is not None, 'Received None in process_response'
+            if isinstance(response, Request):
+                defer.returnValue(response)
+            for method in self.methods['process_response']:
+                response = yield method(request=request, response=response,
+                                        spider=spider)
+                assert isinstance(response, (Response, Request)), \
+                    'Middleware %s.process_response must return Response ' \
+                    'or Request, got %s' % (
+                        method.im_self.__class__.__name__, type(response))
+                if isinstance(response, Request):
+                    break
+            defer.returnValue(response)
+
+        @defer.inlineCallbacks
+        def process_exception(_failure):
+            exception = _failure.value
+            for method in self.methods['process_exception']:
+                response = yield method(request=request, exception=exception,
+                                        spider=spider)
+                assert response is None or isinstance(
+                    response, (Response, Request)), \
+                    'Middleware %s.process_exception must return None, ' \
+                    'Response or Request, got %s' % (
+                        method.im_self.__class__.__name__, type(response))
+                if response:
+                    defer.returnValue(response)
+            _failure.raiseException()
+
+        deferred = mustbe_deferred(process_request, request)
+        deferred.addErrback(process_exception)
+        deferred.addCallback(process_response)
+        return deferred
+
+
 class CustomDownloader(Downloader):
     def __init__(self, crawler):
         # logger.debug('init')
         super(CustomDownloader, self).__init__(crawler)
+        # reuse middleware instances, they are already connected to signals
+        self.middleware = AsyncDownloaderMiddlewareManager(
+            *self.middleware.middlewares)
 
     def needs_backout(self):
         # logger.debug('n/r %s < %s', len(self.active), self.total_concurrency)
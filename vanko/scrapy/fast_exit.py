@@ -176,6 +176,10 @@ class FastExit(object):
                         slot.scheduler.enqueue_request(
                             request.replace(dont_filter=True))
                         count += 1
+                # return batched and prefetched requests to the storage
+                flush = getattr(slot.scheduler, 'flush', None)
+                if flush:
+                    flush()
         self.logger.info('Saved %d unfinished requests', count)
 
     def print_spiders(self, stage):
@@ -1,8 +1,19 @@
 import os
+import io
 import logging
 from time import time
+from email.utils import formatdate
+from collections import OrderedDict
+from twisted.internet import reactor, defer
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+from scrapy.exceptions import IgnoreRequest
 from scrapy.extensions.httpcache import FilesystemCacheStorage
+from scrapy.downloadermiddlewares.httpcache import HttpCacheMiddleware
+from scrapy.utils.misc import load_object
+from scrapy.utils.request import request_fingerprint
 from .settings import CustomSettings
+from .cache_codec import CacheCodec, FileDictStore, CodecWriter
 
 CustomSettings.register_map(
     'httpcachestorage',
@@ -10,6 +21,12 @@ CustomSettings.register_map(
     files='vanko.scrapy.httpcache.SFTPCacheStorage',
     redis='vanko.scrapy.redis.httpcache.RedisCacheStorage',
     mongo='vanko.scrapy.mongo.httpcache.MongoCacheStorage',
+    tiered='vanko.scrapy.httpcache.TieredCacheStorage',
+    pack='vanko.scrapy.pack_httpcache.PackCacheStorage',
+    **{'redis-ttl': 'vanko.scrapy.redis.httpcache.RedisKeyCacheStorage',
+       'redis-async': 'vanko.scrapy.redis.httpcache.AsyncRedisCacheStorage',
+       'mongo-async': 'vanko.scrapy.mongo.httpcache.AsyncMongoCacheStorage',
+       'files-pack': 'vanko.scrapy.sftp_httpcache.SFTPPackCacheStorage'}
     )
 
 CustomSettings.register_map(
@@ -40,6 +57,18 @@ CustomSettings.register(
     HTTPCACHE_TABLE_tmpl_map_httpcachetable='%(HTTPCACHE_BACKEND)s',
     HTTPCACHE_SFTP_tmpl='',
     HTTPCACHE_METADATA=[],
+    HTTPCACHE_MAX_BYTES=0,
+    HTTPCACHE_EVICTION='lru',  # lru, lfu
+    HTTPCACHE_CODEC='gzip',  # gzip, zstd, zstd-dict
+    HTTPCACHE_ZSTD_DICT_SAMPLES=200,
+    HTTPCACHE_ZSTD_DICT_SIZE=112640,
+    HTTPCACHE_DEDUP_BODIES=False,
+    HTTPCACHE_GRIDFS_THRESHOLD=1048576,
+    HTTPCACHE_TIER_STORAGE_tmpl_map_httpcachestorage='%(HTTPCACHE_BACKEND)s',
+    HTTPCACHE_MEMORY_BYTES=64 * 1024 * 1024,
+    HTTPCACHE_ASYNC_THREADS=4,
+    HTTPCACHE_ASYNC_BACKLOG=1000,
+    HTTPCACHE_PACK_SEGMENT_BYTES=64 * 1024 * 1024,
     )
 
 
@@ -52,6 +81,25 @@ class FilesystemCacheStorage2(FilesystemCacheStorage):
     def __init__(self, settings):
         super(FilesystemCacheStorage2, self).__init__(settings)
         self.debug = settings.getbool('DEBUG')
+        self.codec = CacheCodec.from_settings(settings)
+        if self.codec.name != 'gzip':
+            self._open = self._codec_open
+
+    def open_spider(self, spider):
+        super(FilesystemCacheStorage2, self).open_spider(spider)
+        self.codec.open(FileDictStore(
+            os.path.join(self.cachedir, spider.name, 'zdict')))
+
+    def _codec_open(self, path, mode='rb'):
+        if 'w' in mode:
+            return CodecWriter(self.codec, path)
+        with open(path, 'rb') as f:
+            data = f.read()
+        if self.codec.is_compressed(data):
+            data = self.codec.decompress(data)
+        elif self.use_gzip:
+            data = self.codec.decompress(data)  # bare gzip file
+        return io.BytesIO(data)
 
     def retrieve_response(self, spider, request):
         res = super(FilesystemCacheStorage2,
@@ -73,3 +121,220 @@ class FilesystemCacheStorage2(FilesystemCacheStorage):
     def store_response(self, spider, request, response):
         super(FilesystemCacheStorage2,
               self).store_response(spider, request, response)
+
+
+class TieredCacheStorage(object):
+    """
+    Byte-bounded in-process LRU cache in front of another cache storage
+    selected by HTTPCACHE_TIER_STORAGE (by default the HTTPCACHE_BACKEND
+    storage). Counts hits and misses of every tier in crawler stats.
+    """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, settings):
+        self.backend = load_object(settings['HTTPCACHE_TIER_STORAGE'])(
+            settings)
+        self.max_bytes = settings.getint('HTTPCACHE_MEMORY_BYTES')
+        self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.stats = None
+
+    def open_spider(self, spider):
+        self.backend.open_spider(spider)
+        crawler = getattr(spider, 'crawler', None)
+        self.stats = crawler.stats if crawler else None
+        self.spider = spider
+
+    def close_spider(self, spider):
+        self.entries.clear()
+        self.bytes = 0
+        return self.backend.close_spider(spider)
+
+    @classmethod
+    def clear_all(cls, spider):
+        settings = spider.crawler.settings
+        backend = load_object(settings['HTTPCACHE_TIER_STORAGE'])
+        if hasattr(backend, 'clear_all'):
+            backend.clear_all(spider)
+
+    def retrieve_response(self, spider, request):
+        key = request_fingerprint(request)
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            ts, size, response = entry
+            if 0 < self.expiration_secs < time() - ts:
+                self.bytes -= size
+            else:
+                self.entries[key] = entry  # most recently used
+                self._inc_stats('memory', 'hit')
+                return response.replace(flags=[])
+        self._inc_stats('memory', 'miss')
+
+        response = self.backend.retrieve_response(spider, request)
+        self._inc_stats('backend', 'miss' if response is None else 'hit')
+        if response is not None:
+            self._remember(key, response)
+        return response
+
+    def store_response(self, spider, request, response):
+        self._remember(request_fingerprint(request), response)
+        return self.backend.store_response(spider, request, response)
+
+    def _remember(self, key, response):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[1]
+        size = len(response.body) + len(response.url) + sum(
+            len(k) + sum(len(v) for v in vals)
+            for k, vals in response.headers.iteritems())
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (time(), size, response.replace(flags=[]))
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, size, _) = self.entries.popitem(last=False)
+            self.bytes -= size
+
+    def _inc_stats(self, tier, result):
+        if self.stats:
+            self.stats.inc_value('httpcache/%s/%s' % (tier, result),
+                                 spider=self.spider)
+
+
+class AsyncCacheStorageMixin(object):
+    """
+    Runs blocking retrieve/store of a cache storage in a dedicated
+    thread pool. Writes are fire-and-forget until HTTPCACHE_ASYNC_BACKLOG
+    of them are outstanding, then callers get a Deferred to wait on.
+    """
+
+    def __init__(self, settings):
+        super(AsyncCacheStorageMixin, self).__init__(settings)
+        self.threads = settings.getint('HTTPCACHE_ASYNC_THREADS', 4)
+        self.backlog = settings.getint('HTTPCACHE_ASYNC_BACKLOG', 1000)
+        self.pool = None
+        self.shutdown_id = None
+        self.writes = set()
+
+    def open_spider(self, spider):
+        super(AsyncCacheStorageMixin, self).open_spider(spider)
+        self.pool = ThreadPool(1, self.threads, name=type(self).__name__)
+        self.pool.start()
+        # pool threads are not daemonic, never let them outlive reactor
+        self.shutdown_id = reactor.addSystemEventTrigger(
+            'during', 'shutdown', self._stop_pool)
+
+    def close_spider(self, spider):
+        dfd = defer.DeferredList(list(self.writes))
+        dfd.addBoth(lambda _: self._close_spider(spider))
+        return dfd
+
+    def _close_spider(self, spider):
+        if self.shutdown_id is not None:
+            reactor.removeSystemEventTrigger(self.shutdown_id)
+            self.shutdown_id = None
+        self._stop_pool()
+        super(AsyncCacheStorageMixin, self).close_spider(spider)
+
+    def _stop_pool(self):
+        if self.pool is not None:
+            self.pool.stop()
+            self.pool = None
+
+    def retrieve_response_async(self, spider, request):
+        return deferToThreadPool(reactor, self.pool, self.retrieve_response,
+                                 spider, request)
+
+    def store_response_async(self, spider, request, response):
+        dfd = deferToThreadPool(reactor, self.pool, self.store_response,
+                                spider, request, response)
+        self.writes.add(dfd)
+        dfd.addErrback(self._store_failed, request)
+        dfd.addBoth(self._store_done, dfd)
+        if len(self.writes) > self.backlog:
+            return dfd
+
+    def _store_failed(self, failure, request):
+        self.logger.error('Cannot store %s in cache: %s',
+                          request.url, failure.getErrorMessage())
+
+    def _store_done(self, _, dfd):
+        self.writes.discard(dfd)
+
+
+class AsyncHttpCacheMiddleware(HttpCacheMiddleware):
+    """
+    Cache middleware keeping the reactor free while an async storage
+    (e.g. 'redis-async' or 'mongo-async') does its i/o.
+    Storages without async methods are called as usual.
+    Its methods may return Deferreds, so it requires CustomDownloader
+    and must replace the stock HttpCacheMiddleware in
+    DOWNLOADER_MIDDLEWARES explicitly.
+    """
+
+    def spider_closed(self, spider):
+        # let the engine wait for outstanding cache writes
+        return self.storage.close_spider(spider)
+
+    def process_request(self, request, spider):
+        if request.meta.get('dont_cache', False):
+            return
+        if not self.policy.should_cache_request(request):
+            request.meta['_dont_cache'] = True
+            return
+        retrieve = getattr(self.storage, 'retrieve_response_async', None)
+        if retrieve is None:
+            return self._process_cached(
+                self.storage.retrieve_response(spider, request),
+                request, spider)
+        dfd = retrieve(spider, request)
+        dfd.addCallback(self._process_cached, request, spider)
+        return dfd
+
+    def _process_cached(self, cachedresponse, request, spider):
+        if cachedresponse is None:
+            self.stats.inc_value('httpcache/miss', spider=spider)
+            if self.ignore_missing:
+                self.stats.inc_value('httpcache/ignore', spider=spider)
+                raise IgnoreRequest('Ignored request not in cache: %s'
+                                    % request)
+            return
+        cachedresponse.flags.append('cached')
+        if self.policy.is_cached_response_fresh(cachedresponse, request):
+            self.stats.inc_value('httpcache/hit', spider=spider)
+            return cachedresponse
+        request.meta['cached_response'] = cachedresponse
+
+    def process_response(self, request, response, spider):
+        if request.meta.get('dont_cache', False):
+            return response
+        if 'cached' in response.flags or '_dont_cache' in request.meta:
+            request.meta.pop('_dont_cache', None)
+            return response
+        if 'Date' not in response.headers:
+            response.headers['Date'] = formatdate(usegmt=1)
+        cachedresponse = request.meta.pop('cached_response', None)
+        if cachedresponse is None:
+            self.stats.inc_value('httpcache/firsthand', spider=spider)
+        elif self.policy.is_cached_response_valid(cachedresponse, response,
+                                                  request):
+            self.stats.inc_value('httpcache/revalidate', spider=spider)
+            return cachedresponse
+        else:
+            self.stats.inc_value('httpcache/invalidate', spider=spider)
+
+        if not self.policy.should_cache_response(response, request):
+            self.stats.inc_value('httpcache/uncacheable', spider=spider)
+            return response
+        self.stats.inc_value('httpcache/store', spider=spider)
+        store = getattr(self.storage, 'store_response_async', None)
+        if store is None:
+            self.storage.store_response(spider, request, response)
+            return response
+        dfd = store(spider, request, response)
+        if dfd is None:
+            return response
+        # write backlog is full, hold this response until it drains
+        self.stats.inc_value('httpcache/async/backpressure', spider=spider)
+        return dfd.addBoth(lambda _: response)
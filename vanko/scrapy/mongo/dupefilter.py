@@ -1,4 +1,6 @@
+import logging
 from time import time
+from pymongo.errors import DuplicateKeyError, BulkWriteError, OperationFailure
 from scrapy.dupefilters import BaseDupeFilter
 from scrapy.utils.request import request_fingerprint
 from . import connection
@@ -8,12 +10,16 @@ from ...utils.misc import getrunid
 class RFPDupeFilter(BaseDupeFilter):
     """Mongo-based request duplication filter"""
     debug = False
+    logger = logging.getLogger('.'.join(__name__.split('.')[-2:]))
 
     def __init__(self, db, table):
         self.table = db[table]
-        self.table.create_index('fp', background=True)
+        self._create_index()
         self.debug = type(self).debug
 
+    def _create_index(self):
+        self.table.create_index('fp', background=True)
+
     @classmethod
     def from_settings(cls, settings):
         db = connection.from_settings(settings)
@@ -25,15 +31,18 @@ class RFPDupeFilter(BaseDupeFilter):
         return cls.from_settings(crawler.settings)
 
     def request_seen(self, request):
-        fp = request_fingerprint(request)
-        if self.table.find_one(dict(fp=fp)):
+        record = self._make_record(request)
+        if self.table.find_one(dict(fp=record['fp'])):
             return True
-        record = {'fp': fp}
+        self.table.insert(record)
+        return False
+
+    def _make_record(self, request):
+        record = {'fp': request_fingerprint(request)}
         if self.debug:
             record['_url'] = request.url
             record['_run'] = getrunid()
-        self.table.insert(record)
-        return False
+        return record
 
     def close(self, reason):
         """Delete data on close. Called by scrapy's scheduler"""
@@ -42,3 +51,51 @@ class RFPDupeFilter(BaseDupeFilter):
     def clear(self):
         """Clears fingerprints data"""
         self.table.delete_many({})
+
+
+class UniqueRFPDupeFilter(RFPDupeFilter):
+    """
+    Mongo-based request duplication filter relying on unique index.
+    A single insert both checks and records the fingerprint, so two
+    workers can never both pass the same request.
+    A table left by RFPDupeFilter keeps its non-unique "fp" index,
+    then the filter falls back to RFPDupeFilter behaviour.
+    """
+    DUPLICATE_KEY = 11000
+
+    def _create_index(self):
+        try:
+            self.table.create_index('fp', unique=True, background=True)
+            self.unique = True
+        except OperationFailure as err:
+            self.unique = False
+            self.logger.warning(
+                'Cannot create unique index on %s: %s. Falling back to '
+                'non-atomic dupefilter. Drop the "fp_1" index (or the '
+                'table) to enable the unique one.', self.table.name, err)
+
+    def request_seen(self, request):
+        if not self.unique:
+            return super(UniqueRFPDupeFilter, self).request_seen(request)
+        try:
+            self.table.insert_one(self._make_record(request))
+        except DuplicateKeyError:
+            return True
+        return False
+
+    def requests_seen(self, requests):
+        """Check a batch of requests in one round trip"""
+        if not self.unique:
+            return [self.request_seen(r) for r in requests]
+        seen = [False] * len(requests)
+        if not requests:
+            return seen
+        try:
+            self.table.insert_many([self._make_record(r) for r in requests],
+                                   ordered=False)
+        except BulkWriteError as err:
+            for error in err.details['writeErrors']:
+                if error['code'] != self.DUPLICATE_KEY:
+                    raise
+                seen[error['index']] = True
+        return seen
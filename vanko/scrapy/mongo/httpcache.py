@@ -1,8 +1,10 @@
 import logging
-from datetime import datetime
-from cStringIO import StringIO
-from gzip import GzipFile
+import hashlib
+from datetime import datetime, timedelta
 from scrapy.extensions.httpcache import DbmCacheStorage
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
+from ..cache_codec import CacheCodec, MongoDictStore
+from ..httpcache import AsyncCacheStorageMixin
 from . import connection
 from ...utils.misc import getrunid
 
@@ -22,24 +24,39 @@ class MongoCacheStorage(DbmCacheStorage):
         self.compresslevel = s.getint('HTTPCACHE_COMPRESSLEVEL', 6)
         self.metadata = s.getlist('HTTPCACHE_METADATA', [])
         self.encoding = 'iso-8859-1'
+        self.codec = CacheCodec.from_settings(s)
+        self.dedup = s.getbool('HTTPCACHE_DEDUP_BODIES', False)
+        self.gridfs_threshold = s.getint('HTTPCACHE_GRIDFS_THRESHOLD', 0)
 
     def open_spider(self, spider):
+        from gridfs import GridFS
+
         self.coll = self.db[self.table_tpl % {'spider': spider.name}]
+        self.zdict_coll = self.db[self.coll.name + '_zdict']
+        self.bodies = self.db[self.coll.name + '_bodies']
+        self.fs_name = self.coll.name + '_fs'
+        self.fs = GridFS(self.db, collection=self.fs_name)
+        self.codec.open(MongoDictStore(self.zdict_coll))
         self.coll.create_index('key', unique=True, background=True)
         self.coll.create_index('url', background=True)
         self.coll.create_index('ts', background=True)
         self.coll.create_index('status', background=True)
+        if self.dedup:
+            self.coll.create_index('sha1', background=True)
         self.logger.debug('MongoDB cache opened')
 
     def close_spider(self, spider):
         pass
 
     def store_response(self, spider, request, response):
+        from bson import Binary
+        from pymongo import ReturnDocument
+
         record = dict(
             key=self._request_key(request),
             status=response.status,
             url=response.url,
-            headers=dict(response.headers),
+            rawheaders=Binary(headers_dict_to_raw(response.headers)),
             body=response.body,
             gzbody='',
             ts=datetime.utcnow(),
@@ -53,22 +70,94 @@ class MongoCacheStorage(DbmCacheStorage):
                 record['_meta'] = _meta
 
         if self.compress:
-            iobuf = StringIO()
-            with GzipFile('', 'wb', self.compresslevel, iobuf) as gzip:
-                gzip.write(record['body'])
-            gzbody = iobuf.getvalue()
-            iobuf.close()
+            gzbody = self.codec.compress(record['body'])
             if len(gzbody) < len(record['body']):
                 record['body'] = ''
                 record['gzbody'] = gzbody
 
-        self._dict_to_unicode(record)
-        self._dict_to_unicode(record['headers'])
-
-        self.coll.update_one({'key': record['key']}, {'$set': record},
-                             upsert=True)
+        record['gridfs'] = None
+        if self.dedup:
+            record['sha1'] = self._store_body(record, response.body)
+        else:
+            record['sha1'] = None
+            self._offload_body(record)
+        self._to_binary(record)
+
+        old = self.coll.find_one_and_update(
+            {'key': record['key']},
+            {'$set': record, '$unset': {'headers': ''}}, upsert=True,
+            projection={'_id': 0, 'sha1': 1, 'gridfs': 1},
+            return_document=ReturnDocument.BEFORE)
+        if old and old.get('sha1'):
+            self._release_body(old['sha1'])
+        if old and old.get('gridfs'):
+            self.fs.delete(old['gridfs'])
         self.logger.debug('Store %s in mongodb cache', response.url)
 
+    def _store_body(self, record, body):
+        """
+        Move body into "<table>_bodies" keyed by content hash and take
+        a reference. Body is sent to the server only when it is new.
+        Field "ts" keeps the time of the last reference for the collector.
+        """
+        sha1 = hashlib.sha1(body).hexdigest()
+        refer = {'$inc': {'refs': 1}, '$set': {'ts': datetime.utcnow()}}
+        result = self.bodies.update_one({'_id': sha1}, refer)
+        if not result.matched_count:
+            data = dict(body=record['body'], gzbody=record['gzbody'])
+            self._offload_body(data)
+            self._to_binary(data)
+            result = self.bodies.update_one(
+                {'_id': sha1}, dict(refer, **{'$setOnInsert': data}),
+                upsert=True)
+            if result.upserted_id is None and data.get('gridfs'):
+                # a concurrent writer inserted the body first
+                self.fs.delete(data['gridfs'])
+        record['body'] = record['gzbody'] = ''
+        return sha1
+
+    def _release_body(self, sha1):
+        self.bodies.update_one({'_id': sha1}, {'$inc': {'refs': -1}})
+        data = self.bodies.find_one_and_delete(
+            {'_id': sha1, 'refs': {'$lte': 0}}, projection=['gridfs'])
+        if data and data.get('gridfs'):
+            self.fs.delete(data['gridfs'])
+
+    def _offload_body(self, data):
+        """
+        Move a body larger than HTTPCACHE_GRIDFS_THRESHOLD to GridFS
+        collection "<table>_fs", so cache documents stay small
+        """
+        field = 'gzbody' if data['gzbody'] else 'body'
+        size = len(data[field])
+        if not self.gridfs_threshold or size <= self.gridfs_threshold:
+            return
+        data['gridfs'] = self.fs.put(data[field], field=field)
+        data[field] = ''
+
+    def _load_gridfs(self, record):
+        from gridfs import NoFile
+
+        try:
+            grid_out = self.fs.get(record['gridfs'])
+        except NoFile:
+            self.logger.warning('Cached body of %s is missing in GridFS',
+                                record['url'])
+            return False
+        record[grid_out.field] = grid_out.read()
+        return True
+
+    def _load_body(self, record):
+        data = self.bodies.find_one({'_id': record['sha1']},
+                                    projection={'_id': 0, 'refs': 0, 'ts': 0})
+        if not data:
+            self.logger.warning('Cached body %s of %s is missing',
+                                record['sha1'], record['url'])
+            return False
+        self._dict_from_unicode(data)
+        record.update(data)
+        return True
+
     def _read_data(self, spider, request):
         key = self._request_key(request)
         record = self.coll.find_one({'key': key},
@@ -78,25 +167,39 @@ class MongoCacheStorage(DbmCacheStorage):
         record_age = (datetime.utcnow() - record['ts']).total_seconds()
         if 0 < self.expiration_secs < record_age:
             return  # expired
+        if record.get('sha1') and not self._load_body(record):
+            return  # body lost
+        # large bodies are fetched only for fresh hits
+        if record.get('gridfs') and not self._load_gridfs(record):
+            return  # body lost
         self.logger.debug('Retrieve %s from mongodb cache', record['url'])
 
-        self._dict_from_unicode(record)
-        self._dict_from_unicode(record['headers'])
+        if 'rawheaders' in record:
+            record['headers'] = headers_raw_to_dict(record.pop('rawheaders'))
+            # pymongo returns strings as unicode, binary Response needs str
+            record['url'] = record['url'].encode('utf-8')
+            for field in 'body', 'gzbody':
+                # empty bodies were once stored as strings
+                if isinstance(record.get(field), unicode):
+                    record[field] = record[field].encode(self.encoding)
+        else:
+            # legacy records keep latin-1 decoded body and headers
+            self._dict_from_unicode(record)
+            self._dict_from_unicode(record['headers'])
 
         if record.get('gzbody', '') and not record.get('body', ''):
-            iobuf = StringIO(record['gzbody'])
-            with GzipFile('', 'rb', self.compresslevel, iobuf) as gzip:
-                record['body'] = gzip.read()
-                record['gzbody'] = ''
-            iobuf.close()
+            # older records keep bare gzip stream without codec marker
+            record['body'] = self.codec.decompress(record['gzbody'])
+            record['gzbody'] = ''
 
         return record
 
-    def _dict_to_unicode(self, d):
-        encoding = self.encoding
-        for key, val in d.items():
-            if val and isinstance(val, str):
-                d[key] = val.decode(encoding)
+    @staticmethod
+    def _to_binary(d):
+        from bson import Binary
+
+        for key in 'body', 'gzbody':
+            d[key] = Binary(d[key])
 
     def _dict_from_unicode(self, d):
         encoding = self.encoding
@@ -106,9 +209,39 @@ class MongoCacheStorage(DbmCacheStorage):
 
     def _clear(self):
         self.coll.delete_many({})
+        self.zdict_coll.delete_many({})
+        self.bodies.delete_many({})
+        self.db.drop_collection(self.fs_name + '.files')
+        self.db.drop_collection(self.fs_name + '.chunks')
+
+    def collect_garbage(self, grace_secs=3600):
+        """
+        Remove bodies left without references, e.g. by crashed writers.
+        Bodies referenced within grace_secs are kept, their writers may
+        still be storing the cache document.
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=grace_secs)
+        removed = 0
+        old = {'$not': {'$gte': cutoff}}  # matches missing ts too
+        for body in self.bodies.find({'ts': old}, projection=['refs']):
+            if body.get('refs', 0) > 0 and \
+                    self.coll.find_one({'sha1': body['_id']}, ['_id']):
+                continue
+            body = self.bodies.find_one_and_delete(
+                {'_id': body['_id'], 'ts': old}, projection=['gridfs'])
+            if body:
+                removed += 1
+                if body.get('gridfs'):
+                    self.fs.delete(body['gridfs'])
+        self.logger.info('Removed %d orphan bodies', removed)
+        return removed
 
     @classmethod
     def clear_all(cls, spider):
         cache = cls(spider.crawler.settings)
         cache.open_spider(spider)
         cache._clear()
+
+
+class AsyncMongoCacheStorage(AsyncCacheStorageMixin, MongoCacheStorage):
+    """Mongo cache storage doing i/o outside of the reactor thread"""
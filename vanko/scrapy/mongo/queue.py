@@ -1,10 +1,16 @@
 import logging
+import threading
 from time import time, sleep
-from datetime import datetime
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import CursorType, UpdateOne
+from pymongo.errors import CollectionInvalid, PyMongoError
+from scrapy.utils.httpobj import urlparse_cached
 from ..reqser import request_to_dict2, request_from_dict2
 from ...utils.misc import getrunid
 
-__all__ = ['SpiderQueue', 'SpiderPriorityQueue', 'SpiderStack']
+__all__ = ['SpiderQueue', 'SpiderPriorityQueue', 'SpiderStack',
+           'SpiderDomainQueue']
 
 
 class Base(object):
@@ -12,7 +18,12 @@ class Base(object):
     poll_minsec = 0.2
     poll_maxsec = 2.0
     poll_factor = 1.4
+    signal_size = 1024 * 1024
+    signal_secs = 0.5
+    claim_secs = 600
     index_keys = []
+    projection = dict(_id=False, _ts=False, _run=False,
+                      _claim=False, _claimed=False)
     debug = False
 
     logger = logging.getLogger('.'.join(__name__.split('.')[-2:]))
@@ -22,43 +33,293 @@ class Base(object):
         self.spider = spider
         self.table = db[table % dict(spider=spider.name)]
         self.table.create_index(self.index_keys, background=True)
+        self.table.create_index('_claimed', sparse=True, background=True)
         self.debug = type(self).debug
+        self.signals = None
+        self.watcher = None
+        self.last_signal = 0
+        self.last_reclaim = 0
+        self.signal_timer = None
+        self.signal_lock = threading.Lock()
 
     def __len__(self):
         return self.table.count()
 
     def push(self, request):
         """Push a request"""
+        self.table.insert_one(self._make_record(request))
+        self._signal()
+        self.logger.debug('push %s', request)
+
+    def push_many(self, requests):
+        """Push a batch of requests in one round trip"""
+        self.table.insert_many([self._make_record(r) for r in requests])
+        self._signal()
+        self.logger.debug('push %d requests', len(requests))
+
+    def _make_record(self, request):
         record = request_to_dict2(request, self.spider)
         record['_ts'] = datetime.utcnow()
         if self.debug:
             record['_run'] = getrunid()
-        self.table.insert_one(record)
-        self.logger.debug('push %s', request)
+        return record
 
     def pop(self, timeout=0):
-        """Pop a request"""
-        endtime = time() + timeout
+        """
+        Pop a request
+        Polls for up to timeout seconds, unless the queue is watched:
+        waiting consumers are woken up by watch() instead of polling.
+        """
+        endtime = time() + (0 if self.watcher else timeout)
         poll_sec = self.poll_minsec
         while 1:
-            record = self.table.find_one_and_delete(
-                {}, sort=self.index_keys,
-                projection=dict(_id=False, _ts=False, _run=False))
-            if record:
-                request = request_from_dict2(record, self.spider)
-                self.logger.debug('pop (t=%s) %s', timeout, request)
+            request = self._pop_once()
+            if request is not None:
+                self.logger.debug('pop %s', request)
                 return request
             curtime = time()
             if curtime >= endtime:
-                self.logger.debug('pop (t=%s) None', timeout)
                 return
             sleep(min(poll_sec, endtime - curtime))
             poll_sec = min(poll_sec * self.poll_factor, self.poll_maxsec)
 
+    def _pop_once(self):
+        # records claimed by pop_many belong to their claimer
+        record = self.table.find_one_and_delete(
+            {'_claim': None}, sort=self.index_keys,
+            projection=self.projection)
+        if record:
+            return request_from_dict2(record, self.spider)
+
+    def pop_many(self, count, timeout=0):
+        """
+        Pop up to count requests. Records are claimed by a unique token
+        first, so concurrent workers never receive the same request.
+        Claims older than claim_secs are left by crashed workers and
+        get released.
+        """
+        self._release_stale_claims()
+        if count <= 1:
+            request = self.pop(timeout)
+            return [] if request is None else [request]
+        ids = [r['_id'] for r in self.table.find(
+            {'_claim': None}, projection=['_id'],
+            sort=self.index_keys, limit=count)]
+        if not ids:
+            request = self.pop(timeout)
+            return [] if request is None else [request]
+        token = ObjectId()
+        self.table.update_many(
+            {'_id': {'$in': ids}, '_claim': None},
+            {'$set': {'_claim': token, '_claimed': datetime.utcnow()}})
+        # match by _id too, so both queries use the _id index
+        claimed = {'_id': {'$in': ids}, '_claim': token}
+        records = list(self.table.find(claimed, projection=self.projection,
+                                       sort=self.index_keys))
+        self.table.delete_many(claimed)
+        requests = [request_from_dict2(r, self.spider) for r in records]
+        self.logger.debug('pop %d requests', len(requests))
+        return requests
+
+    def _release_stale_claims(self):
+        now = time()
+        if now < self.last_reclaim + self.claim_secs:
+            return
+        self.last_reclaim = now
+        deadline = datetime.utcnow() - timedelta(seconds=self.claim_secs)
+        result = self.table.update_many(
+            {'_claimed': {'$lt': deadline}},
+            {'$set': {'_claim': None}, '$unset': {'_claimed': ''}})
+        if result.modified_count:
+            self.logger.warning('Released %d stale claimed requests',
+                                result.modified_count)
+
     def clear(self):
         """Clear queue/stack"""
         self.table.delete_many({})
 
+    def watch(self, callback):
+        """
+        Call back from a background thread whenever any worker pushes
+        requests. Pushes are signalled through a capped collection
+        "<table>_signal" followed by a tailable cursor.
+        """
+        db = self.table.database
+        name = self.table.name + '_signal'
+        if name not in db.collection_names():
+            try:
+                db.create_collection(name, capped=True, size=self.signal_size)
+            except CollectionInvalid:
+                pass  # created by another worker
+        self.signals = db[name]
+        # tailable cursor dies on an empty collection
+        self.signals.insert_one({'_ts': datetime.utcnow()})
+        self.watcher = SignalWatcher(self.signals, callback, self.logger)
+        self.watcher.start()
+
+    def close(self):
+        """Stop watching for pushed requests"""
+        with self.signal_lock:
+            timer, self.signal_timer = self.signal_timer, None
+        if timer:
+            timer.cancel()
+            self._send_signal()  # do not drop a pending trailing signal
+        if self.watcher:
+            self.watcher.stop()
+            self.watcher = None
+
+    def _signal(self):
+        """
+        Signal at most once per signal_secs. Pushes inside the window
+        are covered by one trailing signal at its end.
+        """
+        if self.signals is None:
+            return
+        with self.signal_lock:
+            wait = self.last_signal + self.signal_secs - time()
+            if wait > 0:
+                if self.signal_timer is None:
+                    self.signal_timer = threading.Timer(
+                        wait, self._trailing_signal)
+                    self.signal_timer.daemon = True
+                    self.signal_timer.start()
+                return
+            self.last_signal = time()
+        self._send_signal()
+
+    def _trailing_signal(self):
+        with self.signal_lock:
+            if self.signal_timer is None:
+                return  # cancelled by close()
+            self.signal_timer = None
+            self.last_signal = time()
+        self._send_signal()
+
+    def _send_signal(self):
+        try:
+            self.signals.insert_one({'_ts': datetime.utcnow()})
+        except PyMongoError as err:
+            self.logger.warning('Cannot signal pushed requests: %s', err)
+
+
+class SpiderDomainQueue(Base):
+    """
+    Per-spider priority queue with fair scheduling between domains.
+    Collection "<table>_domains" keeps domains with the time when their
+    download slot gets free (DOWNLOAD_DELAY after the last pop), so
+    every pop takes a request of the longest ready domain.
+    """
+    index_keys = [('_domain', 1), ('priority', -1), ('_ts', 1)]
+    pop_sort = [('priority', -1), ('_ts', 1)]
+    projection = dict(Base.projection, _domain=False)
+    pop_tries = 3
+
+    def __init__(self, db, spider, table, delay=0):
+        super(SpiderDomainQueue, self).__init__(db, spider, table)
+        self.delay = delay
+        self.domains = db[self.table.name + '_domains']
+        self.domains.create_index('ready', background=True)
+
+    @classmethod
+    def from_scheduler(cls, scheduler, spider, table):
+        return cls(scheduler.storage, spider, table,
+                   delay=scheduler.settings.getfloat('DOWNLOAD_DELAY'))
+
+    def _make_record(self, request):
+        record = super(SpiderDomainQueue, self)._make_record(request)
+        record['_domain'] = urlparse_cached(request).hostname or ''
+        return record
+
+    def push(self, request):
+        """Push a request"""
+        self.push_many([request])
+
+    def push_many(self, requests):
+        """Push a batch of requests in two round trips"""
+        records = [self._make_record(r) for r in requests]
+        self.table.insert_many(records)
+        now = time()
+        self.domains.bulk_write([
+            UpdateOne({'_id': domain}, {'$setOnInsert': {'ready': now}},
+                      upsert=True)
+            for domain in set(r['_domain'] for r in records)
+            ], ordered=False)
+        self._signal()
+        self.logger.debug('push %d requests', len(requests))
+
+    def _pop_once(self):
+        """Pop a request of the first ready domain"""
+        for _ in xrange(self.pop_tries):
+            now = time()
+            domain = self.domains.find_one_and_update(
+                {'ready': {'$lte': now}},
+                {'$set': {'ready': now + self.delay}},
+                sort=[('ready', 1)])
+            if not domain:
+                return
+            record = self.table.find_one_and_delete(
+                {'_domain': domain['_id']},
+                sort=self.pop_sort, projection=self.projection)
+            if record:
+                return request_from_dict2(record, self.spider)
+            self.domains.delete_one({'_id': domain['_id']})
+            # a concurrent push may have missed the deleted domain
+            if self.table.find_one({'_domain': domain['_id']}):
+                self.domains.update_one(
+                    {'_id': domain['_id']},
+                    {'$setOnInsert': {'ready': now}}, upsert=True)
+
+    def pop_many(self, count, timeout=0):
+        """Pop up to count requests, each from the next ready domain"""
+        requests = []
+        while len(requests) < count:
+            request = self.pop()
+            if request is None:
+                break
+            requests.append(request)
+        return requests
+
+    def clear(self):
+        """Clear queue and domain index"""
+        super(SpiderDomainQueue, self).clear()
+        self.domains.delete_many({})
+
+
+class SignalWatcher(threading.Thread):
+    """Background follower of capped signal collection"""
+    retry_secs = 1.0
+
+    def __init__(self, coll, callback, logger):
+        super(SignalWatcher, self).__init__(name='%s-watcher' % coll.name)
+        self.daemon = True
+        self.coll = coll
+        self.callback = callback
+        self.logger = logger
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        last_id = None
+        while not self.stopped.is_set():
+            try:
+                if last_id is None:
+                    last = self.coll.find_one(sort=[('$natural', -1)])
+                    last_id = last['_id'] if last else None
+                query = {} if last_id is None else {'_id': {'$gt': last_id}}
+                cursor = self.coll.find(
+                    query, cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive and not self.stopped.is_set():
+                    try:
+                        last_id = cursor.next()['_id']
+                    except StopIteration:
+                        continue  # server waited for data in vain
+                    self.callback()
+            except PyMongoError as err:
+                self.logger.warning('Signal watcher error: %s', err)
+            self.stopped.wait(self.retry_secs)
+
 
 class SpiderQueue(Base):
     """Per-spider FIFO queue"""
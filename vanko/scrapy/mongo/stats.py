@@ -1,4 +1,6 @@
 import logging
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
 from ..stats import PersistentStatsCollector
 from . import connection
 
@@ -60,3 +62,106 @@ class MongoStatsCollector(PersistentStatsCollector):
 
     def clear_stats(self, spider=None):
         self._coll.delete_many({})
+
+
+class MongoDocStatsCollector(PersistentStatsCollector):
+    """
+    Keeps all stats in a single document and writes buffered changes
+    as one batch of $set/$inc/$max/$min updates (see STATS_FLUSH_SECS).
+    Dots in stat names are stored as full-width dots.
+    """
+    DEFAULT_STATS_MONGODB_URL = 'mongodb://localhost/test'
+    DEFAULT_STATS_TABLE = '%(spider)s_stats'
+    doc_id = 'stats'
+    logger = logging.getLogger('.'.join(__name__.split('.')[-2:]))
+
+    def __init__(self, crawler):
+        s = crawler.settings
+        self._db = connection.from_settings(
+            s.get('STATS_STORAGE_URL', self.DEFAULT_STATS_MONGODB_URL))
+        self._name = s.get('STATS_TABLE', self.DEFAULT_STATS_TABLE)
+        self._coll = None
+        self._dump = s.getbool('STATS_DUMP')
+        self._init_pending(s)
+
+    def open_spider(self, spider):
+        self._coll = self._db[self._name % {'spider': spider.name}]
+        try:
+            self._coll.insert_one({'_id': self.doc_id})
+        except DuplicateKeyError:
+            pass
+        self._start_flushing()
+
+    def close_spider(self, spider, reason):
+        self._stop_flushing()
+        if self._dump:
+            self.dump_stats(spider)
+
+    @staticmethod
+    def _field(key):
+        return key.replace('.', u'\uff0e')
+
+    @staticmethod
+    def _key(field):
+        return field.replace(u'\uff0e', '.')
+
+    def get_value(self, key, default=None, spider=None):
+        field = self._field(key)
+        doc = self._coll.find_one({'_id': self.doc_id}, projection=[field])
+        val = self._merge_pending(key, (doc or {}).get(field))
+        return default if val is None else val
+
+    def get_stats(self, spider=None):
+        self.flush()
+        doc = self._coll.find_one({'_id': self.doc_id}) or {}
+        doc.pop('_id', None)
+        return {self._key(f): v for f, v in doc.items()}
+
+    def set_value(self, key, value, spider=None):
+        self._buffer_set(key, value)
+
+    def set_stats(self, stats, spider=None):
+        self._reset_pending()
+        doc = {self._field(k): v for k, v in stats.items()}
+        self._coll.replace_one({'_id': self.doc_id}, doc, upsert=True)
+
+    def inc_value(self, key, count=1, start=0, spider=None):
+        if self._coll is None:
+            return
+        self._buffer_inc(key, count, start)
+
+    def max_value(self, key, value, spider=None):
+        self._buffer_max(key, value)
+
+    def min_value(self, key, value, spider=None):
+        self._buffer_min(key, value)
+
+    def clear_stats(self, spider=None):
+        self._reset_pending()
+        self._coll.replace_one({'_id': self.doc_id}, {}, upsert=True)
+
+    def _flush_pending(self, sets, incs, maxs, mins):
+        query = {'_id': self.doc_id}
+        requests = []
+        for key, (count, start) in incs.items():
+            if start:
+                field = self._field(key)
+                requests.append(UpdateOne(
+                    {'_id': self.doc_id, field: {'$exists': False}},
+                    {'$set': {field: start}}))
+        # one update can not touch a field in two operators
+        update, fields = {}, set()
+        for op, values in [('$set', sets), ('$inc', incs),
+                           ('$max', maxs), ('$min', mins)]:
+            for key, val in values.items():
+                field = self._field(key)
+                if field in fields:
+                    requests.append(UpdateOne(query, update, upsert=True))
+                    update, fields = {}, set()
+                if op == '$inc':
+                    val = val[0]
+                update.setdefault(op, {})[field] = val
+                fields.add(field)
+        if update:
+            requests.append(UpdateOne(query, update, upsert=True))
+        self._coll.bulk_write(requests, ordered=True)
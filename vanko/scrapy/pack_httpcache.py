@@ -0,0 +1,220 @@
+"""
+Pack-file http cache.
+Responses are appended to segment files "seg-<N>.pack". Index entries
+have fixed size:
+    fingerprint(20) segment(4) offset(8) length(4) timestamp(8)
+Every stored response appends an entry to the journal "index.idx".
+A segment is sealed (never written again) when it grows over
+HTTPCACHE_PACK_SEGMENT_BYTES or when the spider closes. Sealing merges
+the journal into "index.sorted", unique entries sorted by fingerprint,
+which is mmap-ed and binary searched, so only journal entries of the
+current segment are kept in memory.
+"""
+import os
+import re
+import mmap
+import struct
+import heapq
+import logging
+from time import time
+from binascii import unhexlify
+from six.moves import cPickle as pickle
+from scrapy.extensions.httpcache import DbmCacheStorage
+from scrapy.utils.project import data_path
+from .cache_codec import CacheCodec, FileDictStore
+
+
+class PackCacheStorage(DbmCacheStorage):
+    index_entry = struct.Struct('<20sIQId')
+    segment_name = 'seg-%06d.pack'
+    segment_regex = r'^seg-(\d+)\.pack$'
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, settings):
+        s = settings
+        self.cachedir = data_path(s['HTTPCACHE_DIR'])
+        self.expiration_secs = s.getint('HTTPCACHE_EXPIRATION_SECS', 0)
+        self.compress = s.getbool('HTTPCACHE_COMPRESS', False)
+        self.segment_bytes = s.getint('HTTPCACHE_PACK_SEGMENT_BYTES',
+                                      64 * 1024 * 1024)
+        self.codec = CacheCodec.from_settings(s)
+
+    def open_spider(self, spider):
+        self.path = os.path.join(self.cachedir, spider.name)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.codec.open(FileDictStore(os.path.join(self.path, 'zdict')))
+        self.index_path = os.path.join(self.path, 'index.idx')
+        self.sorted_path = os.path.join(self.path, 'index.sorted')
+        self.sorted = self.sorted_file = None
+        self.journal = self._load_journal()
+        self.index_file = open(self.index_path, 'ab')
+        if self.journal:
+            self._merge_index()  # left by a crashed run
+        else:
+            self._map_sorted()
+        numbers = [int(mo.group(1)) for mo in (
+            re.match(self.segment_regex, name)
+            for name in os.listdir(self.path)) if mo]
+        # previous segments are sealed, always start a new one
+        self.segment = max(numbers or [0]) + 1
+        self.writer = None
+        self.readers = {}
+        self.logger.debug('Pack cache opened with %d entries',
+                          self._sorted_count())
+
+    def close_spider(self, spider):
+        self._seal()
+        self.index_file.close()
+        self._unmap_sorted()
+        for reader in self.readers.values():
+            reader.close()
+        self.readers = {}
+
+    def _load_journal(self):
+        journal = {}
+        if not os.path.exists(self.index_path):
+            return journal
+        size = os.path.getsize(self.index_path)
+        size -= size % self.index_entry.size  # torn last entry
+        with open(self.index_path, 'rb') as f:
+            data = f.read(size)
+        unpack = self.index_entry.unpack_from
+        for pos in xrange(0, size, self.index_entry.size):
+            entry = unpack(data, pos)
+            journal[entry[0]] = entry[1:]
+        return journal
+
+    def _map_sorted(self):
+        self._unmap_sorted()
+        if os.path.exists(self.sorted_path) and \
+                os.path.getsize(self.sorted_path):
+            self.sorted_file = open(self.sorted_path, 'rb')
+            self.sorted = mmap.mmap(self.sorted_file.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+
+    def _unmap_sorted(self):
+        if self.sorted is not None:
+            self.sorted.close()
+            self.sorted_file.close()
+        self.sorted = self.sorted_file = None
+
+    def _sorted_count(self):
+        if self.sorted is None:
+            return 0
+        return len(self.sorted) // self.index_entry.size
+
+    def _iter_sorted(self):
+        unpack = self.index_entry.unpack_from
+        for i in xrange(self._sorted_count()):
+            yield unpack(self.sorted, i * self.index_entry.size)
+
+    def _find_sorted(self, fp):
+        size = self.index_entry.size
+        lo, hi = 0, self._sorted_count()
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = mid * size
+            key = self.sorted[pos:pos + 20]
+            if key < fp:
+                lo = mid + 1
+            elif key > fp:
+                hi = mid
+            else:
+                return self.index_entry.unpack_from(self.sorted, pos)[1:]
+
+    def _merge_index(self):
+        """Merge journal into the sorted index and truncate journal"""
+        fresh = [(fp,) + entry for fp, entry in sorted(self.journal.items())]
+        tmp_path = self.sorted_path + '.tmp'
+        pack = self.index_entry.pack
+        with open(tmp_path, 'wb') as f:
+            last = None
+            # journal entries (tag 0) go before older ones with same fp
+            merged = heapq.merge(((e[0], 0, e) for e in fresh),
+                                 ((e[0], 1, e) for e in self._iter_sorted()))
+            for fp, _, entry in merged:
+                if fp != last:
+                    f.write(pack(*entry))
+                    last = fp
+        self._unmap_sorted()
+        os.rename(tmp_path, self.sorted_path)
+        self.index_file.seek(0)
+        self.index_file.truncate()
+        self.journal = {}
+        self._map_sorted()
+
+    def store_response(self, spider, request, response):
+        data = self._encode_response(response)
+        if self.writer is None:
+            self.writer = open(self._segment_path(self.segment), 'ab')
+        offset = self.writer.tell()
+        self.writer.write(data)
+        self.writer.flush()
+        fp = unhexlify(self._request_key(request))
+        entry = (self.segment, offset, len(data), time())
+        # index entry goes after data, so a crash never indexes garbage
+        self.index_file.write(self.index_entry.pack(fp, *entry))
+        self.index_file.flush()
+        self.journal[fp] = entry
+        self.logger.debug('Store %s in pack cache', response.url)
+        if offset + len(data) >= self.segment_bytes:
+            self._seal()
+
+    def _seal(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+        self.writer = None
+        reader = self.readers.pop(self.segment, None)
+        if reader:
+            reader.close()
+        self._merge_index()
+        self.on_sealed(self._segment_path(self.segment))
+        self.segment += 1
+
+    def on_sealed(self, path):
+        """Called when a segment file is complete and indexed"""
+
+    def _read_data(self, spider, request):
+        fp = unhexlify(self._request_key(request))
+        entry = self.journal.get(fp)
+        if entry is None and self.sorted is not None:
+            entry = self._find_sorted(fp)
+        if entry is None:
+            return  # not found
+        segment, offset, length, ts = entry
+        if 0 < self.expiration_secs < time() - ts:
+            return  # expired
+        reader = self.readers.get(segment)
+        if reader is None:
+            path = self._segment_path(segment)
+            if not os.path.exists(path):
+                return  # segment removed
+            reader = self.readers[segment] = open(path, 'rb')
+        reader.seek(offset)
+        data = self._decode_data(reader.read(length))
+        self.logger.debug('Retrieve %s from pack cache', data['url'])
+        return data
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, self.segment_name % segment)
+
+    def _encode_response(self, response):
+        data = dict(
+            status=response.status,
+            url=response.url,
+            headers=dict(response.headers),
+            body=response.body,
+            )
+        data = pickle.dumps(data, protocol=2)
+        if self.compress:
+            gzdata = self.codec.compress(data)
+            if len(gzdata) < len(data):
+                data = gzdata
+        return data
+
+    def _decode_data(self, data):
+        if self.codec.is_compressed(data):
+            data = self.codec.decompress(data)
+        return pickle.loads(data)
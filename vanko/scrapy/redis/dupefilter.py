@@ -5,6 +5,7 @@ Copyright (c) Rolando Espinoza La fuente
 All rights reserved.
 """
 
+import math
 from time import time
 from scrapy.dupefilters import BaseDupeFilter
 from scrapy.utils.request import request_fingerprint
@@ -34,12 +35,27 @@ class RFPDupeFilter(BaseDupeFilter):
         return cls.from_settings(crawler.settings)
 
     def request_seen(self, request):
-        fp = request_fingerprint(request)
-        added = self.server.sadd(self.key, fp)
+        added = self._add(self.server, request)
         if self.debug:
             self.server.sadd(self.key + '-url', request.url)
         return not added
 
+    def requests_seen(self, requests):
+        """Check a batch of requests in one pipelined round trip"""
+        pipe = self.server.pipeline(transaction=False)
+        for request in requests:
+            self._add(pipe, request)
+            if self.debug:
+                pipe.sadd(self.key + '-url', request.url)
+        results = pipe.execute()
+        if self.debug:
+            results = results[::2]
+        return [not added for added in results]
+
+    def _add(self, client, request):
+        """Add request fingerprint, result is true if it was not seen"""
+        return client.sadd(self.key, request_fingerprint(request))
+
     def close(self, reason):
         """Delete data on close. Called by scrapy's scheduler"""
         self.clear()
@@ -48,3 +64,144 @@ class RFPDupeFilter(BaseDupeFilter):
         """Clears fingerprints data"""
         self.server.delete(self.key)
         self.server.delete(self.key + '-url')
+
+
+class BloomDupeFilter(RFPDupeFilter):
+    """
+    Redis-based scalable bloom filter.
+    Fingerprints are hashed into a series of bitmaps. When a bitmap
+    reaches its capacity, the next one is started with larger capacity
+    and tighter error rate, so that the total false positive rate
+    stays below error_rate however many requests are seen.
+    """
+    growth = 2
+    tightening = 0.5
+    max_bits = 2 ** 32  # redis bitmap limit
+    stats_interval = 1000
+
+    # atomic check-and-add across all bitmaps
+    script = """
+        local meta = KEYS[1]
+        local h1, h2 = tonumber(ARGV[1]), tonumber(ARGV[2])
+        local capacity, error_rate = tonumber(ARGV[3]), tonumber(ARGV[4])
+        local growth, tightening = tonumber(ARGV[5]), tonumber(ARGV[6])
+        local max_bits = tonumber(ARGV[7])
+        local slices = tonumber(redis.call('HGET', meta, 'slices') or 1)
+        local ln2 = math.log(2)
+        local cap, bits, hashes
+        -- enhanced double hashing, plain h1 + i * h2 collapses to a few
+        -- bits when h2 shares a factor with the bitmap size
+        local function bit(i)
+            return (h1 + i * h2 + (i * i * i - i) / 6) % bits
+        end
+        for s = 0, slices - 1 do
+            cap = capacity * growth ^ s
+            bits = math.ceil(-cap * math.log(error_rate * tightening ^ s)
+                             / (ln2 * ln2))
+            bits = math.min(bits, max_bits)
+            hashes = math.ceil(bits / cap * ln2)
+            local found = true
+            for i = 0, hashes - 1 do
+                if redis.call('GETBIT', meta .. s, bit(i)) == 0 then
+                    found = false
+                    break
+                end
+            end
+            if found then
+                return 0
+            end
+        end
+        local last = slices - 1
+        for i = 0, hashes - 1 do
+            redis.call('SETBIT', meta .. last, bit(i), 1)
+        end
+        if redis.call('HINCRBY', meta, 'count' .. last, 1) >= cap then
+            redis.call('HSET', meta, 'slices', slices + 1)
+        end
+        return 1
+        """
+
+    def __init__(self, server, key, capacity=1000000, error_rate=0.001,
+                 stats=None):
+        super(BloomDupeFilter, self).__init__(server, key)
+        self.bloom_key = key + '-bloom'
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.stats = stats
+        self._script = server.register_script(self.script)
+        self._count = 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        server = connection.from_settings(settings)
+        key = 'dupefilter:%d' % int(time())
+        return cls(server, key,
+                   settings.getint('SCHEDULER_BLOOM_CAPACITY', 1000000),
+                   settings.getfloat('SCHEDULER_BLOOM_ERROR_RATE', 0.001))
+
+    @classmethod
+    def from_scheduler(cls, scheduler, key):
+        s = scheduler.settings
+        return cls(scheduler.storage, key,
+                   s.getint('SCHEDULER_BLOOM_CAPACITY'),
+                   s.getfloat('SCHEDULER_BLOOM_ERROR_RATE'),
+                   scheduler.stats)
+
+    def request_seen(self, request):
+        seen = super(BloomDupeFilter, self).request_seen(request)
+        self._update_stats(1)
+        return seen
+
+    def requests_seen(self, requests):
+        seen = super(BloomDupeFilter, self).requests_seen(requests)
+        self._update_stats(len(requests))
+        return seen
+
+    def _add(self, client, request):
+        fp = request_fingerprint(request)
+        h1, h2 = int(fp[:8], 16), int(fp[8:16], 16) | 1
+        args = [h1, h2, self.capacity, self.error_rate * (1 - self.tightening),
+                self.growth, self.tightening, self.max_bits]
+        return self._script(keys=[self.bloom_key], args=args, client=client)
+
+    def slice_sizes(self, slices):
+        """Return list of (capacity, bits) tuples for given bitmap count"""
+        ln2 = math.log(2)
+        error_rate = self.error_rate * (1 - self.tightening)
+        sizes = []
+        for s in xrange(slices):
+            cap = self.capacity * self.growth ** s
+            bits = math.ceil(-cap * math.log(error_rate * self.tightening ** s)
+                             / (ln2 * ln2))
+            sizes.append((cap, min(int(bits), self.max_bits)))
+        return sizes
+
+    def get_info(self):
+        """Return count, capacity, slices and memory usage of the filter"""
+        meta = self.server.hgetall(self.bloom_key)
+        slices = int(meta.get('slices', 1))
+        sizes = self.slice_sizes(slices)
+        return dict(
+            count=sum(int(meta.get('count%d' % s, 0))
+                      for s in xrange(slices)),
+            capacity=int(sum(cap for cap, bits in sizes)),
+            slices=slices,
+            bytes=sum(bits // 8 for cap, bits in sizes),
+            )
+
+    def _update_stats(self, count):
+        old_count = self._count
+        self._count += count
+        if not self.stats or \
+                old_count // self.stats_interval == \
+                self._count // self.stats_interval:
+            return
+        for name, value in self.get_info().items():
+            self.stats.set_value('dupefilter/bloom/%s' % name, value)
+
+    def clear(self):
+        """Clears fingerprints data"""
+        keys = self.server.keys(self.bloom_key + '*')
+        if keys:
+            self.server.delete(*keys)
+        self.server.delete(self.key + '-url')
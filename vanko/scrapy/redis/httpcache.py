@@ -1,9 +1,9 @@
 import logging
 from time import time
 from six.moves import cPickle as pickle
-from cStringIO import StringIO
-from gzip import GzipFile
 from scrapy.extensions.httpcache import DbmCacheStorage
+from ..cache_codec import CacheCodec, RedisDictStore
+from ..httpcache import AsyncCacheStorageMixin
 from . import connection
 
 
@@ -21,12 +21,15 @@ class RedisCacheStorage(DbmCacheStorage):
         self.compress = s.getbool('HTTPCACHE_COMPRESS', False)
         self.compresslevel = s.getint('HTTPCACHE_COMPRESSLEVEL', 6)
         self.debug = s.getbool('HTTPCACHE_DEBUG', False)
+        self.codec = CacheCodec.from_settings(s)
 
     def open_spider(self, spider):
         key = self.key_tmpl % {'spider': spider.name}
         self.data_hash = '%s-data' % key
         self.time_hash = '%s-time' % key
         self.url_hash = '%s-url' % key if self.debug else None
+        self.zdict_hash = '%s-zdict' % key
+        self.codec.open(RedisDictStore(self.redis, self.zdict_hash))
         self.logger.debug('Redis cache opened')
 
     def close_spider(self, spider):
@@ -34,51 +37,54 @@ class RedisCacheStorage(DbmCacheStorage):
 
     def store_response(self, spider, request, response):
         key = self._request_key(request)
-        data = dict(
-            status=response.status,
-            url=response.url,
-            headers=dict(response.headers),
-            body=response.body,
-            )
+        data = self._encode_response(response)
         ts = str(time())
-        data = pickle.dumps(data, protocol=2)
-        if self.compress:
-            iobuf = StringIO()
-            iobuf.write('gz~')
-            with GzipFile('', 'wb', self.compresslevel, iobuf) as gzip:
-                gzip.write(data)
-            gzdata = iobuf.getvalue()
-            iobuf.close()
-            if len(gzdata) < len(data):
-                data = gzdata
-        self.redis.hset(self.data_hash, key, data)
-        self.redis.hset(self.time_hash, key, ts)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hset(self.data_hash, key, data)
+        pipe.hset(self.time_hash, key, ts)
         if self.url_hash:
-            self.redis.hset(self.url_hash, key, response.url)
+            pipe.hset(self.url_hash, key, response.url)
+        pipe.execute()
         self.logger.debug('Store %s in redis cache', response.url)
 
     def _read_data(self, spider, request):
         key = self._request_key(request)
-        ts = self.redis.hget(self.time_hash, key)
+        # fetch both fields in one round trip, even if data is expired
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hget(self.time_hash, key)
+        pipe.hget(self.data_hash, key)
+        ts, data = pipe.execute()
         if ts is None:
             return  # not found
         if 0 < self.expiration_secs < time() - float(ts):
             return  # expired
-        data = self.redis.hget(self.data_hash, key)
         if data is None:
             return  # key is dropped
-        if data.startswith('gz~'):
-            iobuf = StringIO(data)
-            iobuf.read(3)
-            with GzipFile('', 'rb', self.compresslevel, iobuf) as gzip:
-                data = gzip.read()
-            iobuf.close()
-        data = pickle.loads(data)
+        data = self._decode_data(data)
         self.logger.debug('Retrieve %s from redis cache', data['url'])
         return data
 
+    def _encode_response(self, response):
+        data = dict(
+            status=response.status,
+            url=response.url,
+            headers=dict(response.headers),
+            body=response.body,
+            )
+        data = pickle.dumps(data, protocol=2)
+        if self.compress:
+            gzdata = self.codec.compress(data)
+            if len(gzdata) < len(data):
+                data = gzdata
+        return data
+
+    def _decode_data(self, data):
+        if self.codec.is_compressed(data):
+            data = self.codec.decompress(data)
+        return pickle.loads(data)
+
     def _clear(self):
-        self.redis.delete(self.time_hash, self.data_hash)
+        self.redis.delete(self.time_hash, self.data_hash, self.zdict_hash)
         if self.url_hash:
             self.redis.delete(self.url_hash)
 
@@ -87,3 +93,181 @@ class RedisCacheStorage(DbmCacheStorage):
         cache = cls(spider.crawler.settings)
         cache.open_spider(spider)
         cache._clear()
+
+
+class RedisKeyCacheStorage(RedisCacheStorage):
+    """
+    Redis cache keeping every response under its own key
+    "<table>:<fingerprint>" with native TTL of HTTPCACHE_EXPIRATION_SECS,
+    so that expired responses free memory by themselves.
+    With HTTPCACHE_MAX_BYTES the storage accounts (approximate) resident
+    size and evicts least recently (HTTPCACHE_EVICTION=lru) or least
+    frequently (lfu) used responses when the budget is exceeded.
+    """
+
+    # Forget up to `limit` responses expired by TTL, return freed bytes
+    reap_function = """
+        local function reap(sizes, usage, total, expires, now, limit)
+            local keys = redis.call('ZRANGEBYSCORE', expires, '-inf', now,
+                                    'LIMIT', 0, limit)
+            local freed = 0
+            for _, key in ipairs(keys) do
+                if redis.call('EXISTS', key) == 0 then
+                    freed = freed + tonumber(redis.call('HGET', sizes, key)
+                                             or 0)
+                    redis.call('HDEL', sizes, key)
+                    redis.call('ZREM', usage, key)
+                    redis.call('ZREM', expires, key)
+                end
+            end
+            if freed > 0 then
+                redis.call('DECRBY', total, freed)
+            end
+            return freed
+        end
+        """
+
+    # KEYS: response, sizes, usage, total, expires
+    # ARGV: data, ttl, usage score, eviction policy, now, reap limit
+    store_script = reap_function + """
+        local old = tonumber(redis.call('HGET', KEYS[2], KEYS[1]) or 0)
+        local ttl = tonumber(ARGV[2])
+        if ttl > 0 then
+            redis.call('SET', KEYS[1], ARGV[1], 'EX', ttl)
+            redis.call('ZADD', KEYS[5], tonumber(ARGV[5]) + ttl, KEYS[1])
+        else
+            redis.call('SET', KEYS[1], ARGV[1])
+            redis.call('ZREM', KEYS[5], KEYS[1])
+        end
+        redis.call('HSET', KEYS[2], KEYS[1], #ARGV[1])
+        if old == 0 or ARGV[4] == 'lru' then
+            redis.call('ZADD', KEYS[3], ARGV[3], KEYS[1])
+        end
+        redis.call('INCRBY', KEYS[4], #ARGV[1] - old)
+        reap(KEYS[2], KEYS[3], KEYS[4], KEYS[5], ARGV[5], ARGV[6])
+        return tonumber(redis.call('GET', KEYS[4]))
+        """
+
+    # KEYS: response, sizes, usage, total, expires
+    # ARGV: usage score, eviction policy
+    read_script = """
+        local data = redis.call('GET', KEYS[1])
+        if data then
+            if ARGV[2] == 'lru' then
+                redis.call('ZADD', KEYS[3], ARGV[1], KEYS[1])
+            else
+                redis.call('ZINCRBY', KEYS[3], 1, KEYS[1])
+            end
+            return data
+        end
+        local size = redis.call('HGET', KEYS[2], KEYS[1])
+        if size then
+            -- expired by TTL, forget its size
+            redis.call('HDEL', KEYS[2], KEYS[1])
+            redis.call('ZREM', KEYS[3], KEYS[1])
+            redis.call('ZREM', KEYS[5], KEYS[1])
+            redis.call('DECRBY', KEYS[4], size)
+        end
+        return false
+        """
+
+    # KEYS: sizes, usage, total, expires
+    # ARGV: max bytes, victims per step, now, reap limit
+    evict_script = reap_function + """
+        reap(KEYS[1], KEYS[2], KEYS[3], KEYS[4], ARGV[3], ARGV[4])
+        local total = tonumber(redis.call('GET', KEYS[3]) or 0)
+        local evicted = 0
+        while total > tonumber(ARGV[1]) do
+            local victims = redis.call('ZRANGE', KEYS[2], 0, ARGV[2] - 1)
+            if #victims == 0 then
+                break
+            end
+            for _, key in ipairs(victims) do
+                total = total - tonumber(redis.call('HGET', KEYS[1], key)
+                                         or 0)
+                evicted = evicted + redis.call('DEL', key)
+                redis.call('HDEL', KEYS[1], key)
+                redis.call('ZREM', KEYS[2], key)
+                redis.call('ZREM', KEYS[4], key)
+            end
+        end
+        redis.call('SET', KEYS[3], math.max(total, 0))
+        return {evicted, math.max(total, 0)}
+        """
+    evict_step = 10
+    reap_step = 100
+
+    def __init__(self, settings):
+        super(RedisKeyCacheStorage, self).__init__(settings)
+        self.max_bytes = settings.getint('HTTPCACHE_MAX_BYTES', 0)
+        self.eviction = settings.get('HTTPCACHE_EVICTION', 'lru')
+        assert self.eviction in ('lru', 'lfu'), \
+            'Invalid HTTPCACHE_EVICTION: %s' % self.eviction
+        self._store_script = self.redis.register_script(self.store_script)
+        self._evict_script = self.redis.register_script(self.evict_script)
+        self._read_script = self.redis.register_script(self.read_script)
+        self.stats = None
+
+    def open_spider(self, spider):
+        self.prefix = self.key_tmpl % {'spider': spider.name}
+        self.sizes_hash = '%s-sizes' % self.prefix
+        self.usage_zset = '%s-usage' % self.prefix
+        self.total_key = '%s-bytes' % self.prefix
+        self.expires_zset = '%s-expires' % self.prefix
+        self.zdict_hash = '%s-zdict' % self.prefix
+        self.codec.open(RedisDictStore(self.redis, self.zdict_hash))
+        crawler = getattr(spider, 'crawler', None)
+        self.stats = crawler.stats if crawler else None
+        self.logger.debug('Redis key cache opened')
+
+    def store_response(self, spider, request, response):
+        key = '%s:%s' % (self.prefix, self._request_key(request))
+        data = self._encode_response(response)
+        if not self.max_bytes:
+            self.redis.set(key, data, ex=self.expiration_secs or None)
+            self.logger.debug('Store %s in redis cache', response.url)
+            return
+        now = time()
+        score = now if self.eviction == 'lru' else 1
+        keys = [key, self.sizes_hash, self.usage_zset, self.total_key,
+                self.expires_zset]
+        total = self._store_script(
+            keys=keys, args=[data, self.expiration_secs, score,
+                             self.eviction, now, self.reap_step])
+        if total > self.max_bytes:
+            evicted, total = self._evict_script(
+                keys=keys[1:], args=[self.max_bytes, self.evict_step,
+                                     now, self.reap_step * 10])
+            if self.stats:
+                self.stats.inc_value('httpcache/evictions', evicted,
+                                     spider=spider)
+        if self.stats:
+            self.stats.set_value('httpcache/resident_bytes', total,
+                                 spider=spider)
+        self.logger.debug('Store %s in redis cache', response.url)
+
+    def _read_data(self, spider, request):
+        key = '%s:%s' % (self.prefix, self._request_key(request))
+        if not self.max_bytes:
+            data = self.redis.get(key)
+        else:
+            # usage is counted only for responses actually found
+            data = self._read_script(
+                keys=[key, self.sizes_hash, self.usage_zset,
+                      self.total_key, self.expires_zset],
+                args=[time(), self.eviction])
+        if data is None:
+            return  # not found or expired
+        data = self._decode_data(data)
+        self.logger.debug('Retrieve %s from redis cache', data['url'])
+        return data
+
+    def _clear(self):
+        keys = list(self.redis.scan_iter(match=self.prefix + ':*'))
+        keys.extend((self.sizes_hash, self.usage_zset, self.total_key,
+                     self.expires_zset, self.zdict_hash))
+        self.redis.delete(*keys)
+
+
+class AsyncRedisCacheStorage(AsyncCacheStorageMixin, RedisCacheStorage):
+    """Redis cache storage doing i/o outside of the reactor thread"""
@@ -5,11 +5,22 @@ Copyright (c) Rolando Espinoza La fuente
 All rights reserved.
 """
 
+import logging
+import threading
+from collections import deque, defaultdict
+from twisted.internet import reactor, defer
 from twisted.internet.threads import deferToThread
 from . import connection
+from ..settings import CustomSettings
 from ..utils import JSONEncoder
 
 
+CustomSettings.register(
+    REDIS_PIPELINE_BATCH_SIZE=500,
+    REDIS_PIPELINE_MAX_PENDING=10000,
+    )
+
+
 class RedisPipeline(object):
     """Pushes serialized item into a redis list/queue"""
 
@@ -38,3 +49,99 @@ class RedisPipeline(object):
     def item_key(self, item, spider):
         """Returns redis key based on given spider"""
         return "%s:items" % spider.name
+
+
+class BatchingRedisPipeline(RedisPipeline):
+    """
+    Buffers encoded items in memory and pushes them from a dedicated thread
+    with multi-value RPUSH commands in one pipeline per batch.
+    Once REDIS_PIPELINE_MAX_PENDING items wait for the thread,
+    process_item returns a Deferred firing when the buffer drains.
+    """
+    logger = logging.getLogger('.'.join(__name__.split('.')[-2:]))
+
+    def __init__(self, server, batch_size=500, max_pending=10000,
+                 stats=None):
+        super(BatchingRedisPipeline, self).__init__(server)
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.stats = stats
+        self.buffer = deque()
+        self.waiters = []
+        self.cond = threading.Condition()
+        self.stopping = False
+        self.closed = None
+        self.thread = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = crawler.settings
+        return cls(connection.from_settings(s),
+                   s.getint('REDIS_PIPELINE_BATCH_SIZE'),
+                   s.getint('REDIS_PIPELINE_MAX_PENDING'),
+                   crawler.stats)
+
+    def open_spider(self, spider):
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, args=(spider,),
+                                       name='redis-pipeline')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close_spider(self, spider):
+        self.closed = defer.Deferred()
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        return self.closed
+
+    def process_item(self, item, spider):
+        # encode now, later pipelines may change the item
+        entry = (self.item_key(item, spider), self.encoder.encode(item))
+        with self.cond:
+            self.buffer.append(entry)
+            pending = len(self.buffer)
+            self.cond.notify()
+        if pending < self.max_pending:
+            return item
+        dfd = defer.Deferred()
+        dfd.addCallback(lambda _: item)
+        self.waiters.append(dfd)
+        return dfd
+
+    def _run(self, spider):
+        while True:
+            with self.cond:
+                while not self.buffer and not self.stopping:
+                    self.cond.wait()
+                if not self.buffer:
+                    break
+                count = min(len(self.buffer), self.batch_size)
+                batch = [self.buffer.popleft() for _ in xrange(count)]
+                pending = len(self.buffer)
+            self._push_batch(batch, spider)
+            if pending < self.max_pending:
+                reactor.callFromThread(self._release_waiters)
+        reactor.callFromThread(self._release_waiters)
+        reactor.callFromThread(self.closed.callback, None)
+
+    def _push_batch(self, batch, spider):
+        lists = defaultdict(list)
+        for key, data in batch:
+            lists[key].append(data)
+        try:
+            pipe = self.server.pipeline(transaction=False)
+            for key, values in lists.iteritems():
+                pipe.rpush(key, *values)
+            pipe.execute()
+        except Exception as err:
+            self.logger.error('Cannot push %d items: %s', len(batch), err)
+            if self.stats:
+                reactor.callFromThread(
+                    self.stats.inc_value, 'item_pipeline/redis/error_count',
+                    len(batch), spider=spider)
+
+    def _release_waiters(self):
+        waiters, self.waiters = self.waiters, []
+        for dfd in waiters:
+            dfd.callback(None)
@@ -5,42 +5,56 @@ Copyright (c) Rolando Espinoza La fuente
 All rights reserved.
 """
 
-from ..reqser import request_to_dict2, request_from_dict2
+import math
+import zlib
+from time import time
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.misc import load_object
+from ..reqser import PickleRequestCodec
+from . import connection
 
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
-
-__all__ = ['SpiderQueue', 'SpiderPriorityQueue', 'SpiderStack']
+__all__ = ['SpiderQueue', 'SpiderPriorityQueue', 'SpiderStack',
+           'SpiderBlockingPriorityQueue', 'SpiderShardedPriorityQueue',
+           'SpiderDomainQueue']
 
 
 class Base(object):
     """Per-spider queue/stack base class"""
     debug = False
 
-    def __init__(self, server, spider, key):
+    def __init__(self, server, spider, key, codec=None):
         """Initialize per-spider redis queue.
 
         Parameters:
             server -- redis connection
             spider -- spider instance
             key -- key for this queue (e.g. "%(spider)s:queue")
+            codec -- request codec (default: pickled request dicts)
         """
         self.server = server
         self.spider = spider
         self.key = key % dict(spider=spider.name)
+        self.codec = codec or PickleRequestCodec()
         self.debug = type(self).debug
         self.url_key = self.key + '-url' if self.debug else None
 
+    @classmethod
+    def from_scheduler(cls, scheduler, spider, key):
+        return cls(scheduler.storage, spider, key,
+                   codec=cls.codec_from_settings(scheduler.settings))
+
+    @staticmethod
+    def codec_from_settings(settings):
+        codec_cls = load_object(settings.get('SCHEDULER_REQUEST_CODEC'))
+        return codec_cls.from_settings(settings)
+
     def _encode_request(self, request):
         """Encode a request object"""
-        return pickle.dumps(request_to_dict2(request, self.spider),
-                            protocol=-1)
+        return self.codec.encode(request, self.spider)
 
     def _decode_request(self, encoded_request):
         """Decode an request previously encoded"""
-        return request_from_dict2(pickle.loads(encoded_request), self.spider)
+        return self.codec.decode(encoded_request, self.spider)
 
     def __len__(self):
         """Return the length of the queue"""
@@ -48,12 +62,34 @@ class Base(object):
 
     def push(self, request):
         """Push a request"""
+        self._push(self.server, request)
+
+    def push_many(self, requests):
+        """Push a batch of requests in one pipelined round trip"""
+        pipe = self.server.pipeline(transaction=False)
+        for request in requests:
+            self._push(pipe, request)
+        pipe.execute()
+
+    def _push(self, client, request):
+        """Push a request using given redis client or pipeline"""
         raise NotImplementedError
 
     def pop(self, timeout=0):
         """Pop a request"""
         raise NotImplementedError
 
+    def pop_many(self, count, timeout=0):
+        """Pop up to count requests, wait only for the first one"""
+        requests = []
+        request = self.pop(timeout)
+        while request is not None:
+            requests.append(request)
+            if len(requests) >= count:
+                break
+            request = self.pop()
+        return requests
+
     def clear(self):
         """Clear queue/stack"""
         self.server.delete(self.key)
@@ -68,11 +104,11 @@ class SpiderQueue(Base):
         """Return the length of the queue"""
         return self.server.llen(self.key)
 
-    def push(self, request):
+    def _push(self, client, request):
         """Push a request"""
-        self.server.lpush(self.key, self._encode_request(request))
+        client.lpush(self.key, self._encode_request(request))
         if self.url_key:
-            self.server.lpush(self.url_key, request.url)
+            client.lpush(self.url_key, request.url)
 
     def pop(self, timeout=0):
         """Pop a request"""
@@ -91,28 +127,252 @@ class SpiderQueue(Base):
 class SpiderPriorityQueue(Base):
     """Per-spider priority queue abstraction using redis' sorted set"""
 
+    # atomic range/remove, safe for concurrent workers
+    pop_script = """
+        local data = redis.call('ZRANGE', KEYS[1], 0, ARGV[1] - 1)
+        if #data > 0 then
+            redis.call('ZREMRANGEBYRANK', KEYS[1], 0, #data - 1)
+        end
+        return data
+        """
+
+    def __init__(self, server, spider, key, codec=None):
+        super(SpiderPriorityQueue, self).__init__(server, spider, key, codec)
+        self._pop_script = server.register_script(self.pop_script)
+
     def __len__(self):
         """Return the length of the queue"""
         return self.server.zcard(self.key)
 
-    def push(self, request):
+    def _push(self, client, request):
         """Push a request"""
         data = self._encode_request(request)
         pairs = {data: -request.priority}
-        self.server.zadd(self.key, **pairs)
+        client.zadd(self.key, **pairs)
 
     def pop(self, timeout=0):
+        """Pop a request"""
+        requests = self.pop_many(1, timeout)
+        if requests:
+            return requests[0]
+
+    def pop_many(self, count, timeout=0):
         """
-        Pop a request
+        Pop up to count requests
         timeout not support in this queue class
         """
-        # use atomic range/remove using multi/exec
-        pipe = self.server.pipeline()
-        pipe.multi()
-        pipe.zrange(self.key, 0, 0).zremrangebyrank(self.key, 0, 0)
-        results, count = pipe.execute()
-        if results:
-            return self._decode_request(results[0])
+        data = self._pop_script(keys=[self.key], args=[count])
+        return [self._decode_request(d) for d in data]
+
+
+class SpiderBlockingPriorityQueue(SpiderPriorityQueue):
+    """
+    Priority queue using ZPOPMIN/BZPOPMIN, requires redis 5.0+.
+    An empty queue is waited on for up to timeout seconds
+    (SCHEDULER_IDLE_BEFORE_CLOSE) server-side. Redis before 6.0 waits
+    for whole seconds only, so the timeout is rounded up there.
+    """
+    fractional_timeout = None  # detected on first blocking pop
+
+    def pop_many(self, count, timeout=0):
+        """Pop up to count requests, wait only for the first one"""
+        data = self.server.execute_command('ZPOPMIN', self.key, count)
+        if not data and timeout > 0:
+            # reply is (key, member, score) or None on timeout
+            data = self.server.execute_command(
+                'BZPOPMIN', self.key, self._blocking_timeout(timeout))
+            data = data[1:] if data else []
+        return [self._decode_request(d) for d in data[::2]]
+
+    def _blocking_timeout(self, timeout):
+        if self.fractional_timeout is None:
+            version = str(self.server.info('server')['redis_version'])
+            major = int(version.split('.')[0])
+            self.fractional_timeout = major >= 6
+        if self.fractional_timeout:
+            return timeout
+        return int(math.ceil(timeout))
+
+
+class SpiderShardedPriorityQueue(SpiderPriorityQueue):
+    """
+    Per-spider priority queue spread over several sorted sets
+    "<key>-shard<N>" by hash of request domain. Shards may live on
+    several redis servers (SCHEDULER_QUEUE_SHARD_URLS).
+    Consumers pop shards round-robin, or prefer their home shard
+    (SCHEDULER_QUEUE_HOME_SHARD) and visit others only when it's empty.
+    Priority order is kept within a shard only.
+    timeout not support in this queue class.
+    """
+
+    def __init__(self, server, spider, key, codec=None,
+                 shards=8, servers=None, home_shard=-1):
+        super(SpiderShardedPriorityQueue, self).__init__(
+            server, spider, key, codec)
+        self.servers = servers or [server]
+        self.shard_keys = ['%s-shard%d' % (self.key, shard)
+                           for shard in xrange(shards)]
+        self.shard_scripts = [
+            self._server(shard).register_script(self.pop_script)
+            for shard in xrange(shards)]
+        self.home_shard = home_shard % shards if home_shard >= 0 else -1
+        self.cursor = max(self.home_shard, 0)
+
+    @classmethod
+    def from_scheduler(cls, scheduler, spider, key):
+        s = scheduler.settings
+        servers = [connection.from_settings(url)
+                   for url in s.getlist('SCHEDULER_QUEUE_SHARD_URLS')]
+        return cls(scheduler.storage, spider, key,
+                   codec=cls.codec_from_settings(s),
+                   shards=s.getint('SCHEDULER_QUEUE_SHARDS', 8),
+                   servers=servers,
+                   home_shard=s.getint('SCHEDULER_QUEUE_HOME_SHARD', -1))
+
+    def _server(self, shard):
+        return self.servers[shard % len(self.servers)]
+
+    def shard_of(self, request):
+        domain = urlparse_cached(request).hostname or ''
+        return (zlib.crc32(domain) & 0xffffffff) % len(self.shard_keys)
+
+    def __len__(self):
+        """Return the total length of all shards"""
+        pipes = {}
+        for shard, key in enumerate(self.shard_keys):
+            server = self._server(shard)
+            pipe = pipes.get(id(server))
+            if pipe is None:
+                pipe = pipes[id(server)] = server.pipeline(transaction=False)
+            pipe.zcard(key)
+        return sum(sum(pipe.execute()) for pipe in pipes.values())
+
+    def push(self, request):
+        """Push a request"""
+        shard = self.shard_of(request)
+        self._push_shard(self._server(shard), shard, request)
+
+    def push_many(self, requests):
+        """Push a batch of requests, one round trip per server"""
+        pipes = {}
+        for request in requests:
+            shard = self.shard_of(request)
+            server = self._server(shard)
+            pipe = pipes.get(id(server))
+            if pipe is None:
+                pipe = pipes[id(server)] = server.pipeline(transaction=False)
+            self._push_shard(pipe, shard, request)
+        for pipe in pipes.values():
+            pipe.execute()
+
+    def _push_shard(self, client, shard, request):
+        data = self._encode_request(request)
+        pairs = {data: -request.priority}
+        client.zadd(self.shard_keys[shard], **pairs)
+
+    def pop_many(self, count, timeout=0):
+        """Pop up to count requests"""
+        num_shards = len(self.shard_keys)
+        start = self.cursor
+        if self.home_shard < 0:
+            self.cursor = (start + 1) % num_shards
+        requests = []
+        for step in xrange(num_shards):
+            shard = (start + step) % num_shards
+            data = self.shard_scripts[shard](
+                keys=[self.shard_keys[shard]], args=[count - len(requests)])
+            requests.extend(self._decode_request(d) for d in data)
+            if len(requests) >= count:
+                break
+        return requests
+
+    def clear(self):
+        """Clear all shards"""
+        super(SpiderShardedPriorityQueue, self).clear()
+        for shard, key in enumerate(self.shard_keys):
+            self._server(shard).delete(key)
+
+
+class SpiderDomainQueue(SpiderPriorityQueue):
+    """
+    Per-spider queue with fair scheduling between domains.
+    Every domain has its own priority queue "<key>-domain:<domain>".
+    Sorted set "<key>-domains" holds domains scored by the time when
+    their download slot gets free (DOWNLOAD_DELAY after the last pop),
+    so a pop always takes requests from ready domains, one per domain.
+    timeout not support in this queue class.
+    """
+
+    push_script = """
+        local index, count, key = KEYS[1], KEYS[2], KEYS[3]
+        redis.call('ZADD', key, ARGV[1], ARGV[2])
+        if not redis.call('ZSCORE', index, ARGV[3]) then
+            redis.call('ZADD', index, ARGV[4], ARGV[3])
+        end
+        return redis.call('INCR', count)
+        """
+
+    pop_script = """
+        local index, count, prefix = KEYS[1], KEYS[2], KEYS[3]
+        local now, delay = tonumber(ARGV[1]), tonumber(ARGV[2])
+        local domains = redis.call('ZRANGEBYSCORE', index, '-inf', now,
+                                   'LIMIT', 0, ARGV[3])
+        local result = {}
+        for _, domain in ipairs(domains) do
+            local key = prefix .. domain
+            local data = redis.call('ZRANGE', key, 0, 0)
+            if #data > 0 then
+                redis.call('ZREMRANGEBYRANK', key, 0, 0)
+                redis.call('DECR', count)
+                table.insert(result, data[1])
+            end
+            if redis.call('ZCARD', key) > 0 then
+                redis.call('ZADD', index, now + delay, domain)
+            else
+                redis.call('ZREM', index, domain)
+            end
+        end
+        return result
+        """
+
+    def __init__(self, server, spider, key, codec=None, delay=0):
+        super(SpiderDomainQueue, self).__init__(server, spider, key, codec)
+        self.delay = delay
+        self.index_key = self.key + '-domains'
+        self.count_key = self.key + '-count'
+        self.domain_prefix = self.key + '-domain:'
+        self._push_script = server.register_script(self.push_script)
+
+    @classmethod
+    def from_scheduler(cls, scheduler, spider, key):
+        s = scheduler.settings
+        return cls(scheduler.storage, spider, key,
+                   codec=cls.codec_from_settings(s),
+                   delay=s.getfloat('DOWNLOAD_DELAY'))
+
+    def __len__(self):
+        """Return the length of the queue"""
+        return int(self.server.get(self.count_key) or 0)
+
+    def _push(self, client, request):
+        """Push a request"""
+        domain = urlparse_cached(request).hostname or ''
+        keys = [self.index_key, self.count_key, self.domain_prefix + domain]
+        args = [-request.priority, self._encode_request(request),
+                domain, time()]
+        self._push_script(keys=keys, args=args, client=client)
+
+    def pop_many(self, count, timeout=0):
+        """Pop up to count requests from different ready domains"""
+        keys = [self.index_key, self.count_key, self.domain_prefix]
+        data = self._pop_script(keys=keys, args=[time(), self.delay, count])
+        return [self._decode_request(d) for d in data]
+
+    def clear(self):
+        """Clear queue and domain index"""
+        super(SpiderDomainQueue, self).clear()
+        keys = self.server.keys(self.domain_prefix + '*')
+        self.server.delete(self.index_key, self.count_key, *keys)
 
 
 class SpiderStack(Base):
@@ -122,11 +382,11 @@ class SpiderStack(Base):
         """Return the length of the stack"""
         return self.server.llen(self.key)
 
-    def push(self, request):
+    def _push(self, client, request):
         """Push a request"""
-        self.server.lpush(self.key, self._encode_request(request))
+        client.lpush(self.key, self._encode_request(request))
         if self.url_key:
-            self.server.lpush(self.url_key, request.url)
+            client.lpush(self.url_key, request.url)
 
     def pop(self, timeout=0):
         """Pop a request"""
@@ -8,6 +8,20 @@ class RedisStatsCollector(PersistentStatsCollector):
     DEFAULT_STATS_REDIS_URL = 'redis://localhost'
     logger = logging.getLogger('.'.join(__name__.split('.')[-2:]))
 
+    # KEYS[1] - stats hash
+    # ARGV - flag ('max' or 'min'), key, value, flag, key, value...
+    extremum_script = """
+        for i = 1, #ARGV, 3 do
+            local old = tonumber(redis.call('HGET', KEYS[1], ARGV[i+1]))
+            local new = tonumber(ARGV[i+2])
+            if old == nil or new == nil or
+                    (ARGV[i] == 'max' and old < new) or
+                    (ARGV[i] == 'min' and old > new) then
+                redis.call('HSET', KEYS[1], ARGV[i+1], ARGV[i+2])
+            end
+        end
+        """
+
     def __init__(self, crawler):
         s = crawler.settings
         self._redis = connection.from_settings(
@@ -15,47 +29,68 @@ class RedisStatsCollector(PersistentStatsCollector):
         self._name = s.get('STATS_TABLE', self.DEFAULT_STATS_TABLE)
         self._hash = None
         self._dump = s.getbool('STATS_DUMP')
-        self._starters = {}
+        self._extremum = self._redis.register_script(self.extremum_script)
+        self._init_pending(s)
 
     def open_spider(self, spider):
         self._hash = self._name % {'spider': spider.name}
+        self._start_flushing()
 
     def close_spider(self, spider, reason):
+        self._stop_flushing()
         if self._dump:
             self.dump_stats(spider)
 
     def get_value(self, key, default=None, spider=None):
         val = self._redis.hget(self._hash, key)
-        return default if val is None else float(val)
+        val = self._merge_pending(key, None if val is None else float(val))
+        return default if val is None else val
 
     def get_stats(self, spider=None):
+        self.flush()
         return self._redis.hgetall(self._hash)
 
     def set_value(self, key, value, spider=None):
-        self._redis.hset(self._hash, key, value)
+        self._buffer_set(key, value)
 
     def set_stats(self, stats, spider=None):
-        self._redis.delete(self._hash)
-        for key, val in stats.iteritems():
-            self._redis.hset(self._hash, key, val)
+        self._reset_pending()
+        pipe = self._redis.pipeline()
+        pipe.delete(self._hash)
+        if stats:
+            pipe.hmset(self._hash, stats)
+        pipe.execute()
 
     def inc_value(self, key, count=1, start=0, spider=None):
         if self._hash is None:
             return
-        if start != self._starters.get(key, 0):
-            self._starters[key] = start
-            self._redis.hsetnx(self._hash, key, start)
-        self._redis.hincrby(self._hash, key, count)
+        self._buffer_inc(key, count, start)
 
     def max_value(self, key, value, spider=None):
-        val = self._redis.hget(self._hash, key)
-        if val is None or val < value:
-            self._redis.hset(self._hash, key, value)
+        self._buffer_max(key, value)
 
     def min_value(self, key, value, spider=None):
-        val = self._redis.hget(self._hash, key)
-        if val is None or val > value:
-            self._redis.hset(self._hash, key, value)
+        self._buffer_min(key, value)
 
     def clear_stats(self, spider=None):
+        self._reset_pending()
         self._redis.delete(self._hash)
+
+    def _flush_pending(self, sets, incs, maxs, mins):
+        pipe = self._redis.pipeline(transaction=False)
+        if sets:
+            pipe.hmset(self._hash, sets)
+        for key, (count, start) in incs.iteritems():
+            if start:
+                pipe.hsetnx(self._hash, key, start)
+            if isinstance(count, float) or isinstance(start, float):
+                pipe.hincrbyfloat(self._hash, key, count)
+            else:
+                pipe.hincrby(self._hash, key, count)
+        args = []
+        for flag, values in ('max', maxs), ('min', mins):
+            for key, value in values.iteritems():
+                args.extend((flag, key, value))
+        if args:
+            self._extremum(keys=[self._hash], args=args, client=pipe)
+        pipe.execute()
@@ -1,10 +1,21 @@
 import six
 import types
+import logging
+import zlib
+from six.moves import cPickle as pickle
 from scrapy import Spider
 from scrapy.utils import reqser
 
+try:
+    import lz4.block as lz4
+except ImportError:
+    lz4 = None
+
+logger = logging.getLogger(__name__)
+
 _request_to_dict_handlers = []
 _request_from_dict_handlers = []
+_serializable_cache = {}
 
 
 def _patch_reqser():
@@ -41,18 +52,177 @@ def request_is_serializable(request):
         if callback is None or isinstance(callback, basestring):
             continue
         if isinstance(callback, types.MethodType):
-            obj = six.get_method_self(callback)
-            if not isinstance(obj, Spider):
-                return False
-            func = six.get_method_function(callback)
-            attr = getattr(obj, func.__name__, None)
-            if callable(attr):
-                continue
-        if isinstance(callback, types.FunctionType) and \
-                callback.__name__.isalnum():
-            continue
-        return False
+            key = (type(six.get_method_self(callback)),
+                   six.get_method_function(callback))
+        elif isinstance(callback, types.FunctionType):
+            # lambdas are created anew per request but share their code
+            key = (callback.__code__, callback.__name__)
+        else:
+            return False
+        try:
+            verdict = _serializable_cache[key]
+        except KeyError:
+            verdict = _serializable_cache[key] = \
+                _callback_is_serializable(callback)
+            if not verdict:
+                logger.warning('Requests with callback %r are not '
+                               'serializable and will not persist', callback)
+        if not verdict:
+            return False
     return True
 
 
+def _callback_is_serializable(callback):
+    if isinstance(callback, types.MethodType):
+        obj = six.get_method_self(callback)
+        if not isinstance(obj, Spider):
+            return False
+        func = six.get_method_function(callback)
+        attr = getattr(obj, func.__name__, None)
+        if callable(attr):
+            return True
+    if isinstance(callback, types.FunctionType) and \
+            callback.__name__.isalnum():
+        return True
+    return False
+
+
+class PickleRequestCodec(object):
+    """
+    Encodes requests for persistent queues as pickled request dicts.
+    This is the original queue format, compression is not supported.
+    """
+    compressions = ('',)
+
+    def __init__(self, compress='', level=6):
+        assert compress in self.compressions, \
+            'Unsupported compression: %s' % compress
+        self.compress = compress
+        self.level = level
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.get('SCHEDULER_REQUEST_COMPRESS', ''),
+                   settings.getint('SCHEDULER_REQUEST_COMPRESSLEVEL', 6))
+
+    def encode(self, request, spider=None):
+        return pickle.dumps(request_to_dict2(request, spider), protocol=-1)
+
+    def decode(self, data, spider=None):
+        return request_from_dict2(pickle.loads(data), spider)
+
+
+class CompactRequestCodec(PickleRequestCodec):
+    """
+    Encodes requests as a tuple of non-default field values prefixed by
+    a bit mask of present fields, so that dict keys and empty headers,
+    cookies and meta are not stored for every request. The result can
+    be compressed with zlib or lz4. Data in the original pickle format
+    is still decoded.
+    Callback and errback names are interned as CRC32 of the name when
+    it maps back to a single attribute of the spider class. Every worker
+    rebuilds the same table from the class, so none has to be shared.
+    """
+    magic = 'R1'
+    compressions = ('', 'zlib', 'lz4')
+    fields = (
+        ('url', None),
+        ('callback', None),
+        ('errback', None),
+        ('method', 'GET'),
+        ('headers', {}),
+        ('body', ''),
+        ('cookies', {}),
+        ('meta', {}),
+        ('_encoding', 'utf-8'),
+        ('priority', 0),
+        ('dont_filter', False),
+        )
+
+    def __init__(self, compress='', level=6):
+        super(CompactRequestCodec, self).__init__(compress, level)
+        assert compress != 'lz4' or lz4 is not None, \
+            'ImportError: lz4'
+        self.flag = compress[:1] or 'n'
+        self.callback_tables = {}
+
+    def _callback_table(self, spider):
+        """Return {crc32: name} of spider class attributes"""
+        cls = type(spider)
+        table = self.callback_tables.get(cls)
+        if table is None:
+            table = {}
+            for name in dir(cls):
+                code = zlib.crc32(name) & 0xffffffff
+                # colliding names are never interned
+                table[code] = None if code in table else name
+            table = self.callback_tables[cls] = table
+        return table
+
+    def _intern(self, name, spider):
+        if spider is None or not isinstance(name, str):
+            return name
+        code = zlib.crc32(name) & 0xffffffff
+        if self._callback_table(spider).get(code) == name:
+            return code
+        return name
+
+    def _unintern(self, value, spider):
+        if not isinstance(value, (int, long)):
+            return value
+        name = self._callback_table(spider).get(value) \
+            if spider is not None else None
+        if name is None:
+            raise ValueError('Unknown callback code %d in %s' %
+                             (value, type(spider).__name__))
+        return name
+
+    def encode(self, request, spider=None):
+        d = request_to_dict2(request, spider)
+        for name in 'callback', 'errback':
+            d[name] = self._intern(d.get(name), spider)
+        mask = 0
+        values = [None]
+        for bit, (name, default) in enumerate(self.fields):
+            value = d.pop(name, default)
+            if value != default:
+                mask |= 1 << bit
+                values.append(value)
+        values[0] = mask
+        if d:
+            # fields from custom reqser handlers
+            values.append(d)
+        data = pickle.dumps(tuple(values), protocol=-1)
+        if self.flag == 'z':
+            data = zlib.compress(data, self.level)
+        elif self.flag == 'l':
+            data = lz4.compress(data)
+        return self.magic + self.flag + data
+
+    def decode(self, data, spider=None):
+        if not data.startswith(self.magic):
+            return super(CompactRequestCodec, self).decode(data, spider)
+        flag, data = data[2], data[3:]
+        if flag == 'z':
+            data = zlib.decompress(data)
+        elif flag == 'l':
+            data = lz4.decompress(data)
+        values = pickle.loads(data)
+        mask, pos = values[0], 1
+        d = {}
+        for bit, (name, default) in enumerate(self.fields):
+            if mask & (1 << bit):
+                d[name] = values[pos]
+                pos += 1
+            elif isinstance(default, dict):
+                d[name] = {}
+            else:
+                d[name] = default
+        if pos < len(values):
+            d.update(values[pos])
+        for name in 'callback', 'errback':
+            d[name] = self._unintern(d[name], spider)
+        return request_from_dict2(d, spider)
+
+
 _patch_reqser()
@@ -6,7 +6,11 @@ All rights reserved.
 """
 
 import logging
+from collections import deque
+from time import time
 from scrapy.utils.misc import load_object
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
 from .settings import CustomSettings
 from .reqser import request_is_serializable
 
@@ -65,6 +69,14 @@ CustomSettings.register_map(
     files='scrapy.dupefilters.RFPDupeFilter',
     redis='vanko.scrapy.redis.dupefilter.RFPDupeFilter',
     mongo='vanko.scrapy.mongo.dupefilter.RFPDupeFilter',
+    **{'redis-bloom': 'vanko.scrapy.redis.dupefilter.BloomDupeFilter',
+       'mongo-unique': 'vanko.scrapy.mongo.dupefilter.UniqueRFPDupeFilter'}
+    )
+
+CustomSettings.register_map(
+    'sqcodec',
+    pickle='vanko.scrapy.reqser.PickleRequestCodec',
+    compact='vanko.scrapy.reqser.CompactRequestCodec',
     )
 
 CustomSettings.register(
@@ -72,6 +84,9 @@ CustomSettings.register(
     SCHEDULER_PERSIST=True,
     SCHEDULER_IDLE_BEFORE_CLOSE=0.5,
     SCHEDULER_DEBUG=False,
+    SCHEDULER_BATCH_SIZE=100,
+    SCHEDULER_BATCH_SECS=1.0,
+    SCHEDULER_PREFETCH=0,
     SCHEDULER_tmpl_map_scheduler='normal',
     SCHEDULER_tmpl_map_scheduler_on_crawl='%(SCHEDULER_BACKEND)s',
     SCHEDULER_STORAGE_CLASS_tmpl_map_ssclass='%(SCHEDULER_BACKEND)s',
@@ -82,10 +97,18 @@ CustomSettings.register(
     SCHEDULER_QUEUE_CLASS_FILES='scrapy.squeues.PickleLifoDiskQueue',
     SCHEDULER_QUEUE_CLASS_REDIS='vanko.scrapy.redis.queue.SpiderPriorityQueue',
     SCHEDULER_QUEUE_CLASS_MONGO='vanko.scrapy.mongo.queue.SpiderPriorityQueue',
+    SCHEDULER_REQUEST_CODEC_tmpl_map_sqcodec='pickle',
+    SCHEDULER_REQUEST_COMPRESS='',  # zlib, lz4
+    SCHEDULER_REQUEST_COMPRESSLEVEL=6,
+    SCHEDULER_QUEUE_SHARDS=8,
+    SCHEDULER_QUEUE_SHARD_URLS=[],
+    SCHEDULER_QUEUE_HOME_SHARD=-1,
     SCHEDULER_QUEUE_NONSER_CLASS_tmpl='scrapy.squeues.LifoMemoryQueue',
     SCHEDULER_DUPEFILTER_TABLE_tmpl_map_sdftable='%(SCHEDULER_BACKEND)s',
     SCHEDULER_DUPEFILTER_CLASS_tmpl_map_sdfclass='%(SCHEDULER_BACKEND)s',
     SCHEDULER_DUPEFILTER_NONSER_CLASS_tmpl='scrapy.dupefilters.RFPDupeFilter',
+    SCHEDULER_BLOOM_CAPACITY=1000000,
+    SCHEDULER_BLOOM_ERROR_RATE=0.001,
     )
 
 
@@ -98,7 +121,8 @@ class PersistentScheduler(object):
     def __init__(self, backend, storage_cls, storage_url,
                  persist, idle_before_close, debug,
                  queue_table, queue_cls, queue_nonser_cls,
-                 dfilter_table, dfilter_cls, dfilter_nonser_cls):
+                 dfilter_table, dfilter_cls, dfilter_nonser_cls,
+                 batch_size=0, batch_secs=0, prefetch=0, settings=None):
         self.backend = backend
         self.storage_cls = storage_cls
         self.storage_url = storage_url
@@ -111,7 +135,18 @@ class PersistentScheduler(object):
         self.dfilter_table = dfilter_table
         self.dfilter_cls = dfilter_cls
         self.dfilter_nonser_cls = dfilter_nonser_cls
+        self.batch_size = batch_size
+        self.batch_secs = batch_secs
+        self.batch = []
+        self.batch_time = 0
+        self.batch_loop = None
+        self.prefetch = prefetch
+        self.prefetched = deque()
+        self.settings = settings
         self.stats = None
+        self.crawler = None
+        self.watching = False
+        self.idle_until = None
 
     @classmethod
     def from_settings(cls, settings):
@@ -132,6 +167,10 @@ class PersistentScheduler(object):
                 settings.get('SCHEDULER_DUPEFILTER_CLASS')),
             dfilter_nonser_cls=load_object(
                 settings.get('SCHEDULER_DUPEFILTER_NONSER_CLASS')),
+            batch_size=settings.getint('SCHEDULER_BATCH_SIZE'),
+            batch_secs=settings.getfloat('SCHEDULER_BATCH_SECS'),
+            prefetch=settings.getint('SCHEDULER_PREFETCH'),
+            settings=settings,
             )
 
     @classmethod
@@ -139,32 +178,73 @@ class PersistentScheduler(object):
         scheduler = cls.from_settings(crawler.settings)
         # FIXME: for now, stats are only supported from this constructor
         scheduler.stats = crawler.stats
+        scheduler.crawler = crawler
         return scheduler
 
     def open(self, spider):
         self.spider = spider
         self.storage = self.storage_cls(self.storage_url)
         self.queue_cls.debug = self.debug
-        self.queue = self.queue_cls(
-            self.storage, spider, self.queue_table % dict(spider=spider.name))
+        self.queue = self._create(
+            self.queue_cls,
+            spider, self.queue_table % dict(spider=spider.name))
         self.queue_nonser = self.queue_nonser_cls()
         self.dfilter_cls.debug = self.debug
-        self.dfilter = self.dfilter_cls(
-            self.storage, self.dfilter_table % dict(spider=spider.name))
+        self.dfilter = self._create(
+            self.dfilter_cls, self.dfilter_table % dict(spider=spider.name))
         self.dfilter_nonser = self.dfilter_nonser_cls()
         if self.idle_before_close < 0:
             self.idle_before_close = 0
+        watch = getattr(self.queue, 'watch', None)
+        if watch and self.crawler:
+            # non-blocking queue will wake up the engine on pushes
+            watch(self._wakeup)
+            self.watching = True
+        if self.batch_size > 1 and self.batch_secs > 0:
+            # flush aged batches while the engine does not ask for requests
+            self.batch_loop = LoopingCall(self._flush_aged_batch)
+            self.batch_loop.start(self.batch_secs / 2.0, now=False)
         if len(self.queue):
             spider.logger.info('Resuming crawl (%d requests scheduled)'
                                % len(self.queue))
 
+    def _create(self, cls, *args):
+        """Create queue or dupefilter, configurable ones may access us"""
+        if hasattr(cls, 'from_scheduler'):
+            return cls.from_scheduler(self, *args)
+        return cls(self.storage, *args)
+
     def close(self, reason):
+        if self.batch_loop and self.batch_loop.running:
+            self.batch_loop.stop()
+        self.batch_loop = None
+        self.flush()
+        # late requests (e.g. saved by FastExit) must not stick in buffers
+        self.batch_size = self.prefetch = 0
+        if self.watching:
+            self.queue.close()
+            self.watching = False
         if not self.persist:
             self.dfilter.clear()
             self.queue.clear()
 
+    def flush(self):
+        """Save batched and prefetched requests to the persistent queue"""
+        self.flush_batch()
+        if self.prefetched:
+            requests = list(self.prefetched)
+            self.prefetched.clear()
+            self._push_many(requests)
+            self.logger.debug('returned %d prefetched requests',
+                              len(requests))
+
     def enqueue_request(self, request):
-        if not request_is_serializable(request):
+        serializable = request_is_serializable(request)
+        if self.stats:
+            self.stats.inc_value(
+                'scheduler/reqser/%s' % ('yes' if serializable else 'no'),
+                spider=self.spider)
+        if not serializable:
             if not request.dont_filter and \
                     self.dfilter_nonser.request_seen(request):
                 return
@@ -175,6 +255,14 @@ class PersistentScheduler(object):
             self.logger.debug('enqueue (unser) %s', request)
             return
 
+        if self.batch_size > 1:
+            if not self.batch:
+                self.batch_time = time()
+            self.batch.append(request)
+            if len(self.batch) >= self.batch_size:
+                self.flush_batch()
+            return
+
         if not request.dont_filter and self.dfilter.request_seen(request):
             # self.logger.debug('seen %s', request)
             return
@@ -186,28 +274,111 @@ class PersistentScheduler(object):
         self.logger.debug('enqueue %s', request)
         self.queue.push(request)
 
+    def flush_batch(self):
+        """Filter and push buffered requests in bulk"""
+        requests, self.batch = self.batch, []
+        self.batch_time = 0
+        if not requests:
+            return
+
+        filtered = [r for r in requests if not r.dont_filter]
+        seen = iter(self._requests_seen(filtered))
+        fresh = [r for r in requests if r.dont_filter or not next(seen)]
+        if fresh:
+            self._push_many(fresh)
+
+        if self.stats:
+            inc_value = self.stats.inc_value
+            inc_value('scheduler/enqueued/%s' % self.backend,
+                      count=len(fresh), spider=self.spider)
+            inc_value('scheduler/batch/count', spider=self.spider)
+            inc_value('scheduler/batch/requests',
+                      count=len(requests), spider=self.spider)
+            self.stats.max_value('scheduler/batch/max_size',
+                                 len(requests), spider=self.spider)
+        self.logger.debug('flush %d requests (%d new)',
+                          len(requests), len(fresh))
+
+    def _flush_aged_batch(self):
+        if self.batch and time() - self.batch_time >= self.batch_secs:
+            try:
+                self.flush_batch()
+            except Exception as err:
+                # an error would stop the loop for the rest of the crawl
+                self.logger.error('Cannot flush request batch: %s', err)
+
+    def _requests_seen(self, requests):
+        requests_seen = getattr(self.dfilter, 'requests_seen', None)
+        if requests_seen:
+            return requests_seen(requests)
+        return [self.dfilter.request_seen(r) for r in requests]
+
+    def _push_many(self, requests):
+        push_many = getattr(self.queue, 'push_many', None)
+        if push_many:
+            push_many(requests)
+        else:
+            for request in requests:
+                self.queue.push(request)
+
     def next_request(self):
         request = self.queue_nonser.pop()
         if request is not None:
-            self.self.logger.debug('next nonser %s', request)
+            self.logger.debug('next nonser %s', request)
             if self.stats:
                 self.stats.inc_value('scheduler/dequeued/nonser',
                                      spider=self.spider)
             return request
+        if self.batch and time() - self.batch_time >= self.batch_secs:
+            self.flush_batch()
         block_pop_timeout = self.idle_before_close
-        request = self.queue.pop(block_pop_timeout)
+        request = self._pop(0 if self.batch else block_pop_timeout)
+        if request is None and self.batch:
+            self.flush_batch()
+            request = self._pop(block_pop_timeout)
+        if request is not None:
+            self.idle_until = None
+        elif self.watching and self.idle_until is None:
+            # keep spider open for a while instead of blocking in pop
+            self.idle_until = time() + self.idle_before_close
+            reactor.callLater(self.idle_before_close, self._schedule_next)
         if request and self.stats:
             self.stats.inc_value('scheduler/dequeued/%s' % self.backend,
                                  spider=self.spider)
         self.logger.debug('next %s', request)
         return request
 
+    def _pop(self, timeout):
+        if self.prefetch <= 1:
+            return self.queue.pop(timeout)
+        if not self.prefetched:
+            pop_many = getattr(self.queue, 'pop_many', None)
+            if pop_many:
+                self.prefetched.extend(pop_many(self.prefetch, timeout))
+            else:
+                request = self.queue.pop(timeout)
+                if request is not None:
+                    self.prefetched.append(request)
+        if self.prefetched:
+            return self.prefetched.popleft()
+
     def __len__(self):
-        return len(self.queue)
+        return len(self.queue) + len(self.batch) + len(self.prefetched)
 
     def has_pending_requests(self):
+        if self.idle_until is not None and time() < self.idle_until:
+            return True
         return len(self) > 0
 
+    def _wakeup(self):
+        """Called from queue watcher thread when requests are pushed"""
+        reactor.callFromThread(self._schedule_next)
+
+    def _schedule_next(self):
+        slot = self.crawler.engine.slot
+        if slot:
+            slot.nextcall.schedule()
+
 
 class DummyStorage(object):
     def __init__(self, url):
@@ -2,6 +2,7 @@ import os
 import logging
 from twisted.internet.threads import deferToThread
 from .httpcache import FilesystemCacheStorage2
+from .pack_httpcache import PackCacheStorage
 
 try:
     from ..utils.sftp import SFTPClient
@@ -9,11 +10,11 @@ except ImportError:
     SFTPClient = None
 
 
-class SFTPCacheStorage(FilesystemCacheStorage2):
-    logger = logging.getLogger(__name__)
+class SFTPSyncMixin(object):
+    """Uploads cache files to HTTPCACHE_SFTP server"""
 
     def __init__(self, settings):
-        super(SFTPCacheStorage, self).__init__(settings)
+        super(SFTPSyncMixin, self).__init__(settings)
         self.sftp_cli = None
         self.sftp_url = settings.get('HTTPCACHE_SFTP')
         if self.sftp_url:
@@ -23,26 +24,44 @@ class SFTPCacheStorage(FilesystemCacheStorage2):
                 'ImportError: vanko.scrapy.utils.SFTPClient'
 
     def open_spider(self, spider):
-        super(SFTPCacheStorage, self).open_spider(spider)
+        super(SFTPSyncMixin, self).open_spider(spider)
         if self.sftp_url:
             self.sftp_cli = SFTPClient(self.sftp_url,
                                        local_dir=self.cachedir)
             self.sftp_bg = 'bg=1' in self.sftp_cli.options
 
     def close_spider(self, spider):
-        super(SFTPCacheStorage, self).close_spider(spider)
+        self.sftp_bg = False  # finish last uploads before disconnecting
+        super(SFTPSyncMixin, self).close_spider(spider)
         if self.sftp_cli:
             self.sftp_cli.close()
 
+    def _upload(self, *paths):
+        if self.sftp_bg:
+            return deferToThread(self._upload_files, paths)
+        else:
+            self._upload_files(paths)
+
+    def _upload_files(self, paths):
+        for path in paths:
+            self.sftp_cli.upload_file(path)
+
+
+class SFTPCacheStorage(SFTPSyncMixin, FilesystemCacheStorage2):
+    logger = logging.getLogger(__name__)
+
     def store_response(self, spider, request, response):
         super(SFTPCacheStorage, self).store_response(spider, request, response)
         if self.sftp_cli:
             rpath = self._get_request_path(spider, request)
-            if self.sftp_bg:
-                return deferToThread(self._upload_items, rpath)
-            else:
-                self._upload_items(rpath)
-
-    def _upload_items(self, rpath):
-        for item in self.response_items:
-            self.sftp_cli.upload_file(os.path.join(rpath, item))
+            return self._upload(*[os.path.join(rpath, item)
+                                  for item in self.response_items])
+
+
+class SFTPPackCacheStorage(SFTPSyncMixin, PackCacheStorage):
+    """Pack cache shipping whole sealed segments with the sorted index"""
+    logger = logging.getLogger(__name__)
+
+    def on_sealed(self, path):
+        if self.sftp_cli:
+            self._upload(path, self.sorted_path)
@@ -8,14 +8,14 @@ import urllib
 
 from scrapy import Spider, signals
 from scrapy.utils import project, log
+from scrapy.utils.misc import load_object
 from scrapy.settings import default_settings
 from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
 
 from .settings import CustomSettings, ACTION_PARAMETER, DEFAULT_ACTION
 from .redis import connection as redis_conn
 from .mongo import connection as mongo_conn
-from .redis.httpcache import RedisCacheStorage
-from .mongo.httpcache import MongoCacheStorage
 from ..utils import JSONEncoder
 from ..utils.misc import getrunid
 
@@ -26,16 +26,30 @@ CustomSettings.register(
     SPIDER_BACKEND_tmpl='%(STORAGE_BACKEND)s',
     UPLOAD_INFO_KEY='%(spider)s:upload-info',
     UPLOAD_INFO_RESET=False,
+    ITEM_STORE_BATCH_SIZE=100,
+    ITEM_STORE_BATCH_SECS=1.0,
+    ITEM_KEY_BLOCK=1000,
     )
 
 
 class CustomSpider(Spider):
     key_field = 'key'
 
+    # KEYS[1] - item hash, KEYS[2] - key sequence, ARGV[1] - block size
+    next_keys_script = """
+        if redis.call('EXISTS', KEYS[2]) == 0 then
+            redis.call('SETNX', KEYS[2], redis.call('HLEN', KEYS[1]))
+        end
+        return redis.call('INCRBY', KEYS[2], ARGV[1])
+        """
+
     def __init__(self, *args, **kwargs):
         super(CustomSpider, self).__init__(*args, **kwargs)
         self.action = kwargs.pop(ACTION_PARAMETER, None)
         self.redis = self.mongo = None
+        self.item_batch = []
+        self.item_flush_loop = None
+        self.key_blocks = {}
 
     @classmethod
     def update_settings(cls, settings):
@@ -98,7 +112,12 @@ class CustomSpider(Spider):
         self.upload_info_key = self.settings.get('UPLOAD_INFO_KEY')
         self.encoder = JSONEncoder()
         self.crawler_stopped = False
+        self.item_batch_size = self.settings.getint('ITEM_STORE_BATCH_SIZE')
         self.open_database()
+        batch_secs = self.settings.getfloat('ITEM_STORE_BATCH_SECS')
+        if self.item_batch_size > 0 and batch_secs > 0:
+            self.item_flush_loop = LoopingCall(self.flush_items)
+            self.item_flush_loop.start(batch_secs, now=False)
 
         self._flag_exit = self._flag_stop = True
         for action in self.action_list:
@@ -110,6 +129,9 @@ class CustomSpider(Spider):
             self.abort(0)
 
     def closed(self, reason):
+        if self.item_flush_loop and self.item_flush_loop.running:
+            self.item_flush_loop.stop()
+        self.flush_items()
         if reason == 'finished':
             self.on_finished()
         else:
@@ -118,6 +140,8 @@ class CustomSpider(Spider):
     def open_database(self):
         if self.backend == 'redis':
             self.redis = redis_conn.from_settings(self.settings)
+            self._next_keys = self.redis.register_script(
+                self.next_keys_script)
         if self.backend == 'mongo':
             self.mongo = mongo_conn.from_settings(self.settings)
 
@@ -132,9 +156,11 @@ class CustomSpider(Spider):
         if self.redis or self.mongo:
             table = self.get_table_name()
         if self.redis and table:
-            self.redis.delete(table)
+            self.redis.delete(table, table + '-seq')
         if self.mongo and table:
             self.mongo[table].delete_many({})
+            self.mongo.drop_collection(table + '_seq')
+        self.key_blocks = {}
 
     def get_db(self):
         if self.redis:
@@ -154,22 +180,118 @@ class CustomSpider(Spider):
             key = self.get_next_key(table)
         if debug is None:
             debug = self.debug
+        if not self.redis and not self.mongo:
+            return
         if self.redis:
-            self.redis.hset(table, key, self.encoder.encode(data))
+            data = self.encoder.encode(data)
         if self.mongo:
+            # callers may reuse the dict while the batch is pending
+            data = dict(data)
             data[self.key_field] = key
             if debug:
                 data['_run'] = getrunid()
-            self.mongo[table].update_one(
-                {self.key_field: key}, {'$set': data}, upsert=True)
+        self.item_batch.append((table, key, data))
+        if len(self.item_batch) >= getattr(self, 'item_batch_size', 0):
+            self.flush_items()
+
+    def flush_items(self):
+        """Write buffered items in one round trip"""
+        batch, self.item_batch = self.item_batch, []
+        if not batch:
+            return
+        stats = self.crawler.stats
+        stored = 0
+        try:
+            if self.redis:
+                stored += self._flush_redis_items(batch)
+            if self.mongo:
+                stored += self._flush_mongo_items(batch)
+        except Exception as err:
+            self.logger.error('Cannot store %d items: %s',
+                              len(batch) - stored, err)
+        if stored:
+            stats.inc_value('item_store/stored', stored, spider=self)
+        if stored < len(batch):
+            stats.inc_value('item_store/error_count', len(batch) - stored,
+                            spider=self)
+
+    def _flush_redis_items(self, batch):
+        """Return number of stored items"""
+        pipe = self.redis.pipeline(transaction=False)
+        for table, key, data in batch:
+            pipe.hset(table, key, data)
+        results = pipe.execute(raise_on_error=False)
+        errors = [res for res in results if isinstance(res, Exception)]
+        if errors:
+            self.logger.error('Cannot store %d items: %s',
+                              len(errors), errors[0])
+        return len(results) - len(errors)
+
+    def _flush_mongo_items(self, batch):
+        """Return number of stored items"""
+        from pymongo import UpdateOne
+        from pymongo.errors import BulkWriteError
+
+        stored = 0
+        for table in set(table for table, _, _ in batch):
+            requests = [
+                UpdateOne({self.key_field: key}, {'$set': data},
+                          upsert=True)
+                for _table, key, data in batch if _table == table]
+            try:
+                self.mongo[table].bulk_write(requests)
+                stored += len(requests)
+            except BulkWriteError as err:
+                # ordered bulk write stops on the first failed item
+                done = err.details['nMatched'] + err.details['nUpserted']
+                stored += done
+                self.logger.error('Cannot store %d items: %s',
+                                  len(requests) - done,
+                                  err.details['writeErrors'])
+            except Exception as err:
+                self.logger.error('Cannot store %d items: %s',
+                                  len(requests), err)
+        return stored
 
     def get_next_key(self, table=None, name_base=None):
         table = table or self.get_table_name(name_base=name_base)
         assert self.redis or self.mongo, 'No table for next key'
+        block = self.key_blocks.get(table)
+        if not block or block[0] > block[1]:
+            block = self.key_blocks[table] = self._allocate_keys(table)
+        key = block[0]
+        block[0] += 1
+        return key
+
+    def _allocate_keys(self, table):
+        """
+        Reserve a block of ITEM_KEY_BLOCK keys from a counter shared by
+        all workers, "<table>-seq" key or "<table>_seq" collection.
+        The counter starts from the number of items in the table.
+        """
+        size = max(self.settings.getint('ITEM_KEY_BLOCK'), 1)
         if self.redis:
-            return self.redis.hlen(table) + 1
+            last = self._next_keys(keys=[table, table + '-seq'],
+                                   args=[size])
         if self.mongo:
-            return self.mongo[table].count() + 1
+            from pymongo import ReturnDocument
+            from pymongo.errors import DuplicateKeyError
+
+            seq = self.mongo[table + '_seq']
+            doc = seq.find_one_and_update(
+                {'_id': 'key'}, {'$inc': {'seq': size}},
+                return_document=ReturnDocument.AFTER)
+            if doc is None:
+                try:
+                    seq.insert_one({'_id': 'key',
+                                    'seq': self.mongo[table].count()})
+                except DuplicateKeyError:
+                    pass  # initialized by another worker
+                doc = seq.find_one_and_update(
+                    {'_id': 'key'}, {'$inc': {'seq': size}},
+                    return_document=ReturnDocument.AFTER)
+            last = doc['seq']
+        return [last - size + 1, last]
 
     def _process_store_item(self, item):
         process = getattr(self, 'process_store_item', None)
@@ -228,20 +350,31 @@ class CustomSpider(Spider):
             db = mongo_conn.from_settings(ss_url)
             for table in tables:
                 db[table].delete_many({})
+            # derived collections, e.g. domain index or push signals
+            for name in db.collection_names():
+                if any(name.startswith(table + '_') for table in tables):
+                    self.logger.debug('Dropping mongo table: %s', name)
+                    db.drop_collection(name)
 
         if backend == 'redis' and tables:
-            self.logger.debug('Deleting redis keys: %s', ', '.join(tables))
             redis = redis_conn.from_settings(ss_url)
+            # also drop derived keys, e.g. bloom filter bitmaps
+            for key in tables[:]:
+                if not key.endswith('-url'):
+                    tables.extend(redis.keys(key + '-*'))
+            self.logger.debug('Deleting redis keys: %s', ', '.join(tables))
             redis.delete(*tables)
 
     def clear_cache(self, what=''):
         s = self.settings
         enabled = (s.getbool('HTTPCACHE_ENABLED') and s.get('HTTPCACHE_TABLE'))
         backend = s.get('HTTPCACHE_BACKEND')
-        if what in ('redis', 'all') and enabled and backend == 'redis':
-            RedisCacheStorage.clear_all(self)
-        if what in ('mongo', 'all') and enabled and backend == 'mongo':
-            MongoCacheStorage.clear_all(self)
+        if what in (backend, 'all') and enabled and \
+                backend in ('redis', 'mongo'):
+            # configured storage knows its own keys, e.g. redis-ttl
+            storage = load_object(s['HTTPCACHE_STORAGE'])
+            if hasattr(storage, 'clear_all'):
+                storage.clear_all(self)
         if what in ('disk', 'all'):
             for subdir in '', self.settings['HTTPCACHE_DIR']:
                 path = os.path.join(project.data_path(subdir), self.name)
@@ -1,4 +1,5 @@
 from pprint import pformat
+from twisted.internet.task import LoopingCall
 from .settings import CustomSettings
 
 
@@ -8,6 +9,7 @@ CustomSettings.register_map(
     files='scrapy.statscollectors.MemoryStatsCollector',
     redis='vanko.scrapy.redis.stats.RedisStatsCollector',
     mongo='vanko.scrapy.mongo.stats.MongoStatsCollector',
+    **{'mongo-doc': 'vanko.scrapy.mongo.stats.MongoDocStatsCollector'}
     )
 
 CustomSettings.register_map(
@@ -32,10 +34,107 @@ CustomSettings.register(
     STATS_STORAGE_URL_tmpl_map_statsurl='%(STATS_BACKEND)s',
     STATS_TABLE_tmpl_map_statstable='%(STATS_BACKEND)s',
     STATS_DUMP=False,
+    STATS_FLUSH_SECS=0.0,
     )
 
 
 class PersistentStatsCollector(object):
+    """
+    Base of stats collectors keeping stats in a database.
+    Subclasses calling _init_pending() buffer changes locally and write
+    them in one batch by _flush_pending() every STATS_FLUSH_SECS seconds
+    (or right away, when it is zero).
+    """
+
     def dump_stats(self, spider):
         self.logger.info('Dumping Scrapy stats:\n' + pformat(self.get_stats()),
                          extra={'spider': spider})
+
+    def _init_pending(self, settings):
+        self._flush_secs = settings.getfloat('STATS_FLUSH_SECS')
+        self._flush_loop = None
+        self._reset_pending()
+
+    def _reset_pending(self):
+        self._pending_set = {}
+        self._pending_inc = {}  # key -> [count, start]
+        self._pending_max = {}
+        self._pending_min = {}
+
+    def _start_flushing(self):
+        if self._flush_secs > 0:
+            self._flush_loop = LoopingCall(self.flush)
+            self._flush_loop.start(self._flush_secs, now=False)
+
+    def _stop_flushing(self):
+        if self._flush_loop and self._flush_loop.running:
+            self._flush_loop.stop()
+        self._flush_loop = None
+        self.flush()
+
+    def flush(self):
+        """Write pending changes in one batch"""
+        if not (self._pending_set or self._pending_inc or
+                self._pending_max or self._pending_min):
+            return
+        pending = (self._pending_set, self._pending_inc,
+                   self._pending_max, self._pending_min)
+        self._reset_pending()
+        try:
+            self._flush_pending(*pending)
+        except Exception as err:
+            self.logger.error('Cannot flush stats: %s', err)
+
+    def _flush_pending(self, sets, incs, maxs, mins):
+        raise NotImplementedError
+
+    def _changed(self):
+        if not self._flush_loop:
+            self.flush()
+
+    def _buffer_set(self, key, value):
+        self._pending_inc.pop(key, None)
+        self._pending_max.pop(key, None)
+        self._pending_min.pop(key, None)
+        self._pending_set[key] = value
+        self._changed()
+
+    def _buffer_inc(self, key, count, start):
+        if key in self._pending_set:
+            self._pending_set[key] += count
+        elif key in self._pending_inc:
+            self._pending_inc[key][0] += count
+        else:
+            self._pending_inc[key] = [count, start]
+        self._changed()
+
+    def _buffer_max(self, key, value):
+        if key in self._pending_set:
+            self._pending_set[key] = max(self._pending_set[key], value)
+        else:
+            self._pending_max[key] = max(
+                self._pending_max.get(key, value), value)
+        self._changed()
+
+    def _buffer_min(self, key, value):
+        if key in self._pending_set:
+            self._pending_set[key] = min(self._pending_set[key], value)
+        else:
+            self._pending_min[key] = min(
+                self._pending_min.get(key, value), value)
+        self._changed()
+
+    def _merge_pending(self, key, value):
+        """Apply pending changes of key to value read from database"""
+        if key in self._pending_set:
+            return self._pending_set[key]
+        if key in self._pending_inc:
+            count, start = self._pending_inc[key]
+            value = (start if value is None else value) + count
+        if key in self._pending_max:
+            value = self._pending_max[key] if value is None else \
+                max(value, self._pending_max[key])
+        if key in self._pending_min:
+            value = self._pending_min[key] if value is None else \
+                min(value, self._pending_min[key])
+        return value
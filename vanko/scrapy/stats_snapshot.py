@@ -0,0 +1,195 @@
+import os
+import math
+import logging
+from time import time
+from collections import defaultdict
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.project import data_path
+from twisted.internet.task import LoopingCall
+from .settings import CustomSettings
+from .redis import connection as redis_conn
+from .mongo import connection as mongo_conn
+from ..utils import JSONEncoder
+
+
+CustomSettings.register_map(
+    'statssnapshottable',
+    normal='%(spider)s-stats.jl',
+    files='%(spider)s-stats.jl',
+    redis='%(spider)s:stats-snapshots',
+    mongo='%(spider)s_stats_snapshots',
+    )
+
+CustomSettings.register(
+    STATS_SNAPSHOT_ENABLED=False,
+    STATS_SNAPSHOT_SECS=60.0,
+    STATS_SNAPSHOT_MAXLEN=10080,  # a week of minutes
+    STATS_SNAPSHOT_BACKEND_tmpl='%(STATS_BACKEND)s',
+    STATS_SNAPSHOT_TABLE_tmpl_map_statssnapshottable=(
+        '%(STATS_SNAPSHOT_BACKEND)s'),
+    )
+
+
+class LatencyHistogram(object):
+    """
+    Streaming histogram with logarithmic buckets, every bucket is
+    `precision` times wider than the previous one, so percentiles are
+    off by at most that ratio.
+    """
+
+    def __init__(self, precision=1.1, min_value=0.001):
+        self.log_base = math.log(precision)
+        self.min_value = min_value
+        self.buckets = defaultdict(int)
+        self.count = 0
+        self.max = 0
+
+    def add(self, value):
+        value = max(value, self.min_value)
+        index = int(math.log(value / self.min_value) / self.log_base)
+        self.buckets[index] += 1
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        rank = self.count * percent / 100.0
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                # upper bound of the bucket
+                return min(self.max, self.min_value *
+                           math.exp((index + 1) * self.log_base))
+        return self.max
+
+    def summary(self, percents=(50, 90, 95, 99)):
+        summary = dict(count=self.count, max=self.max,
+                       buckets={str(k): v for k, v in self.buckets.items()})
+        for percent in percents:
+            summary['p%d' % percent] = self.percentile(percent)
+        return summary
+
+
+class StatsSnapshot(object):
+    """
+    This extension saves crawler stats every STATS_SNAPSHOT_SECS seconds
+    together with per-minute rates of counters and the download latency
+    histogram of the interval. Snapshots go to a redis stream, a capped
+    mongo collection or a local json-lines file, keeping the last
+    STATS_SNAPSHOT_MAXLEN entries.
+    """
+    logger = logging.getLogger(__name__.rpartition('.')[2])
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def __init__(self, crawler):
+        s = crawler.settings
+        if not s.getbool('STATS_SNAPSHOT_ENABLED'):
+            raise NotConfigured
+        self.stats = crawler.stats
+        self.interval = s.getfloat('STATS_SNAPSHOT_SECS')
+        self.maxlen = s.getint('STATS_SNAPSHOT_MAXLEN')
+        self.backend = s.get('STATS_SNAPSHOT_BACKEND')
+        self.table_tmpl = s.get('STATS_SNAPSHOT_TABLE')
+        self.storage_url = s.get('STATS_STORAGE_URL')
+        self.encoder = JSONEncoder()
+        self.loop = None
+        crawler.signals.connect(self.spider_opened, signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signals.spider_closed)
+        crawler.signals.connect(self.response_received,
+                                signals.response_received)
+
+    def spider_opened(self, spider):
+        table = self.table_tmpl % {'spider': spider.name}
+        if self.backend == 'redis':
+            self.redis = redis_conn.from_settings(self.storage_url)
+            self.stream = table
+        elif self.backend == 'mongo':
+            db = mongo_conn.from_settings(self.storage_url)
+            if table not in db.collection_names():
+                db.create_collection(table, capped=True, max=self.maxlen,
+                                     size=self.maxlen * 16384)
+            self.coll = db[table]
+        else:
+            self.path = os.path.join(data_path(''), table)
+            self.lines = 0
+            if os.path.exists(self.path):
+                with open(self.path) as f:
+                    self.lines = sum(1 for _ in f)
+        self.spider = spider
+        self.last_time = time()
+        self.last_counters = {}
+        self.latency = LatencyHistogram()
+        self.loop = LoopingCall(self.snapshot)
+        self.loop.start(self.interval, now=False)
+
+    def spider_closed(self, spider):
+        if self.loop and self.loop.running:
+            self.loop.stop()
+            self.snapshot()
+
+    def response_received(self, response, request, spider):
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self.latency.add(latency)
+
+    def snapshot(self):
+        now = time()
+        elapsed = max(now - self.last_time, 0.001)
+        counters = {}
+        for key, val in self.stats.get_stats().items():
+            val = self._number(val)
+            if val is not None:
+                counters[key] = val
+        rates = {k: (v - self.last_counters.get(k, 0)) * 60.0 / elapsed
+                 for k, v in counters.items()
+                 if v != self.last_counters.get(k, 0)}
+        data = dict(ts=now, secs=elapsed, stats=counters, rates=rates,
+                    latency=self.latency.summary())
+        self.last_time = now
+        self.last_counters = counters
+        self.latency = LatencyHistogram()
+        try:
+            self._save(data)
+        except Exception as err:
+            self.logger.warning('Cannot save stats snapshot: %s', err)
+
+    @staticmethod
+    def _number(val):
+        # persistent collectors may return numbers as strings
+        if isinstance(val, basestring):
+            try:
+                return float(val)
+            except ValueError:
+                return
+        if isinstance(val, (int, long, float)) and not isinstance(val, bool):
+            return val
+
+    def _save(self, data):
+        if self.backend == 'redis':
+            self.redis.execute_command(
+                'XADD', self.stream, 'MAXLEN', '~', self.maxlen, '*',
+                'data', self.encoder.encode(data))
+        elif self.backend == 'mongo':
+            # field names may not contain dots
+            for name in 'stats', 'rates':
+                data[name] = {k.replace('.', u'\uff0e'): v
+                              for k, v in data[name].items()}
+            self.coll.insert_one(data)
+        else:
+            with open(self.path, 'a') as f:
+                f.write(self.encoder.encode(data) + '\n')
+            self.lines += 1
+            if self.lines >= 2 * self.maxlen:
+                self._truncate_file()
+
+    def _truncate_file(self):
+        with open(self.path) as f:
+            lines = f.readlines()[-self.maxlen:]
+        with open(self.path + '.tmp', 'w') as f:
+            f.writelines(lines)
+        os.rename(self.path + '.tmp', self.path)
+        self.lines = len(lines)